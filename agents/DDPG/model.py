@@ -1,17 +1,21 @@
 import numpy as np
-import torch.nn.functional as F
 
-from commons.networks import Actor, Critic
+from commons.networks import Actor, Critic, soft_update
 from commons.Abstract_Agent import AbstractAgent
 
 
 class DDPG(AbstractAgent):
 
+    policy_networks = ('actor.nn',)
+    training_attributes = ('actor.nn', 'actor.target_nn', 'actor.optimizer',
+                           'critic.nn', 'critic.target_nn', 'critic.optimizer')
+
     def __init__(self, device, folder, config):
         super().__init__(device, folder, config)
 
         self.critic = Critic(self.state_size, self.action_size, device, self.config)
         self.actor = Actor(self.state_size, self.action_size, device, self.config)
+        self.set_policy_precision()
 
     def select_action(self, state, episode=None, evaluation=False):
         assert (episode is not None) or evaluation
@@ -24,12 +28,17 @@ class DDPG(AbstractAgent):
             noise = np.random.normal(scale=self.config['EXPLO_SIGMA'], size=self.action_size)
             return np.clip(action+noise, -1, 1)
 
-    def optimize(self):
+    def select_actions(self, states, episode=None, evaluation=False):
+        assert (episode is not None) or evaluation
+        actions = self.actor.select_actions(states)
+
+        if not evaluation:
+            actions += np.random.normal(scale=self.config['EXPLO_SIGMA'], size=actions.shape)
+        return np.clip(actions, -1, 1, out=actions)
 
-        if len(self.memory) < self.config['BATCH_SIZE']:
-            return {}
+    def update(self, batch, update_policy=True):
 
-        states, actions, rewards, next_states, done = self.get_batch()
+        states, actions, rewards, next_states, done = batch
 
         # Compute Q(s,a) using critic network
         current_Q = self.critic(states, actions)
@@ -44,7 +53,7 @@ class DDPG(AbstractAgent):
         target_Q = rewards + (1 - done) * self.config['GAMMA'] * target_Q
 
         # Critic loss by mean squared error
-        loss_critic = F.mse_loss(current_Q, target_Q)
+        loss_critic = self.td_loss(current_Q, target_Q)
 
         # Optimize the critic network
         self.critic.update(loss_critic)
@@ -53,9 +62,8 @@ class DDPG(AbstractAgent):
         loss_actor = -self.critic(states, self.actor(states)).mean()
         self.actor.update(loss_actor)
 
-        # Soft parameter update
-        self.critic.update_target(self.config['TAU'])
-        self.actor.update_target(self.config['TAU'])
+        # Soft parameter update of both target networks at once
+        soft_update((self.critic, self.actor), self.config['TAU'])
 
         return {'actor_loss': loss_actor.item(), 'critic_loss': loss_critic.item()}
 
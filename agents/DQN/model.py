@@ -1,24 +1,23 @@
 import random
 
+import numpy as np
 import torch
-import torch.nn.functional as F
 
 from commons.networks import QAgent
-from commons.utils import NStepsReplayMemory, get_epsilon_threshold
+from commons.utils import get_epsilon_threshold
 from commons.Abstract_Agent import AbstractAgent
 
 
 class DQN(AbstractAgent):
 
+    policy_networks = ('agent.nn',)
+    training_attributes = ('agent.nn', 'agent.target_nn', 'agent.optimizer', 'agent.scheduler')
+
     def __init__(self, device, folder, config):
         super().__init__(device, folder, config)
 
-        self.memory = NStepsReplayMemory(self.config['MEMORY_CAPACITY'], self.config['N_STEP'], self.config['GAMMA'])
-
         self.agent = QAgent(self.state_size, self.action_size, self.device, self.config)
-
-        # Compute gamma^n for n-steps return
-        self.gamma_n = self.config['GAMMA']**self.config['N_STEP']
+        self.set_policy_precision()
 
     def select_action(self, state, episode=None, evaluation=False):
         assert (episode is not None) or evaluation
@@ -28,6 +27,15 @@ class DQN(AbstractAgent):
         else:
             return random.randrange(self.action_size)
 
+    def select_actions(self, states, episode=None, evaluation=False):
+        assert (episode is not None) or evaluation
+        actions = self.agent.select_actions(states)
+
+        if not evaluation:
+            explore = np.random.random(len(actions)) <= get_epsilon_threshold(episode, self.config)
+            actions[explore] = np.random.randint(self.action_size, size=explore.sum())
+        return actions
+
     def intermediate_reward(self, reward, next_state):
         if self.config['GAME'] == 'Acrobot-v1' and next_state[0] != 0:
             return reward + 1 - next_state[0]
@@ -40,12 +48,9 @@ class DQN(AbstractAgent):
         else:
             return torch.tensor([reward], device=self.device)
 
-    def optimize(self):
-
-        if len(self.memory) < self.config['BATCH_SIZE']:
-            return {}
+    def update(self, batch, update_policy=True):
 
-        states, actions, rewards, next_states, done = self.get_batch()
+        states, actions, rewards, next_states, done = batch
 
         # Compute Q(s_t, a) - the model computes Q(s_t), then we select the columns of actions taken
         current_Q = self.agent(states).gather(1, actions.unsqueeze(1))
@@ -65,10 +70,11 @@ class DQN(AbstractAgent):
             next_Q = self.agent.target(next_states).max(1)[0].unsqueeze(1)
             # =====================================================================
 
-        # Compute the expected Q values : y[i]= r[i] + gamma * Q'(s[i+1], a[i+1])
-        target_Q = rewards + (1 - done) * self.gamma_n * next_Q
+        # Compute the expected Q values : y[i]= r[i] + gamma^n * Q'(s[i+n], a[i+n])
+        gamma_n = self.config['GAMMA']**self.memory.n_step
+        target_Q = rewards + (1 - done) * gamma_n * next_Q
 
-        loss = F.mse_loss(current_Q, target_Q)
+        loss = self.td_loss(current_Q, target_Q)
 
         # Optimize the model
         self.agent.update(loss)
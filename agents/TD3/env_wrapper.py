@@ -1,9 +1,12 @@
 
+import copy
+import multiprocessing
+
 import numpy as np
 from gym.envs.classic_control import PendulumEnv
 from gym.envs.box2d.lunar_lander import *
 
-from utils import ReplayMemory
+from commons.memory import ReplayMemory
 
 LunarLander.continuous = True
 
@@ -16,6 +19,16 @@ class PendulumWrapper(PendulumEnv):
         self.last_u = None
         return self._get_obs()
 
+    def snapshot(self):
+        """Returns what restore needs to resume the environment from its current state."""
+        return self.state.copy(), self.last_u
+
+    def restore(self, snapshot):
+        """Puts back the environment in the state of snapshot, and returns its observation."""
+        state, self.last_u = snapshot
+        self.state = state.copy()
+        return self._get_obs()
+
 
 class LunarWrapper(LunarLander):
 
@@ -133,33 +146,126 @@ class LunarWrapper(LunarLander):
                                  angularVelocity_test=angularVelocity,
                                  seed=1234)
 
+    def snapshot(self):
+        """Returns what restore needs to resume the environment from its current state: the
+        positions and velocities of the lander and of its legs, and the random generator.
+
+        The terrain is not saved, which is the same after each reset (seed 1234).
+        """
+        bodies = [(tuple(body.position), body.angle, tuple(body.linearVelocity), body.angularVelocity)
+                  for body in [self.lander] + self.legs]
+        return (bodies, [leg.ground_contact for leg in self.legs], self.game_over, self.prev_shaping,
+                copy.deepcopy(self.np_random), self.last_observation)
+
+    def restore(self, snapshot):
+        """Puts back the lander in the state of snapshot, in the current world, and returns its
+        observation."""
+        if self.lander is None:
+            self.forced_reset(seed=1234)
+
+        bodies, contacts, self.game_over, self.prev_shaping, np_random, observation = snapshot
+        for body, (position, angle, linear_velocity, angular_velocity) in zip([self.lander] + self.legs, bodies):
+            body.transform = (position, angle)
+            body.linearVelocity = linear_velocity
+            body.angularVelocity = angular_velocity
+            body.awake = True
+        for leg, contact in zip(self.legs, contacts):
+            leg.ground_contact = contact
+        self.np_random = copy.deepcopy(np_random)
+        self.last_observation = observation
+        return np.array(observation)
+
+    def step(self, action):
+        # The observation is kept to be returned by restore
+        result = super().step(action)
+        self.last_observation = result[0]
+        return result
+
     def copy(self):
-        x, y = self.lander.position
-        angle = self.lander.angle
-        linearVelocity = self.lander.linearVelocity.copy()
-        angularVelocity = self.lander.angularVelocity
         new_env = LunarWrapper()
-        new_env.forced_reset(x_test=x, y_test=y, angle_test=angle,
-                             linearVelocity_test=linearVelocity,
-                             angularVelocity_test=angularVelocity,
-                             seed=1234)
+        new_env.forced_reset(seed=1234)
+        new_env.restore(self.snapshot())
         return new_env
 
 
-def generate_memory(size, game='Pendulum'):
+def make_pendulum(config):
+    return PendulumWrapper()
+
+
+def make_lunar(config):
+    return LunarWrapper()
+
+
+def angle_normalize(x):
+    return ((x + np.pi) % (2 * np.pi)) - np.pi
 
-    if game.startswith('Pendulum'):
-        env = PendulumWrapper()
-    elif game.startswith('LunarLander'):
-        env = LunarWrapper()
 
-    memory = ReplayMemory(100000)
+def generate_pendulum_transitions(size, chunk_size=100000):
+    """Yields chunks of transitions from random pendulum states and random actions.
 
+    The dynamics of PendulumEnv.step are applied to a whole chunk of states at once.
+    """
+    env = PendulumWrapper()
+    high = np.array([np.pi, 8])
+
+    for start in range(0, size, chunk_size):
+        n = min(chunk_size, size - start)
+        th, thdot = np.random.uniform(low=-high, high=high, size=(n, 2)).T
+        u = np.random.uniform(-env.max_torque, env.max_torque, size=(n, 1)).astype(np.float32)
+
+        costs = angle_normalize(th)**2 + .1*thdot**2 + .001*(u[:, 0]**2)
+        new_thdot = thdot + (-3*env.g/(2*env.l) * np.sin(th + np.pi) + 3./(env.m*env.l**2)*u[:, 0]) * env.dt
+        new_th = th + new_thdot*env.dt
+        new_thdot = np.clip(new_thdot, -env.max_speed, env.max_speed)
+
+        states = np.stack([np.cos(th), np.sin(th), thdot], axis=1)
+        next_states = np.stack([np.cos(new_th), np.sin(new_th), new_thdot], axis=1)
+        yield states, u, -costs, next_states, np.zeros(n)
+
+
+def _generate_lunar_chunk(args):
+    size, seed = args
+    np.random.seed(seed)
+    env = LunarWrapper()
+    env.action_space.seed(seed)
+
+    states = np.empty((size, *env.observation_space.shape))
+    actions = np.empty((size, *env.action_space.shape))
+    rewards = np.empty(size)
+    next_states = np.empty((size, *env.observation_space.shape))
+    done = np.empty(size)
     for i in range(size):
-        s = env.reset()
-        a = env.action_space.sample()
-        s_, r, d, _ = env.step(a)
+        states[i] = env.reset()
+        actions[i] = env.action_space.sample()
+        next_states[i], rewards[i], done[i], _ = env.step(actions[i])
+    env.close()
+
+    return states, actions, rewards, next_states, done
+
+
+def generate_lunar_transitions(size, nb_workers=None, chunk_size=10000):
+    """Yields chunks of transitions from random lunar lander states and random actions,
+    generated by a pool of processes."""
+    nb_chunks = (size + chunk_size - 1) // chunk_size
+    tasks = [(min(chunk_size, size - i*chunk_size), np.random.randint(2**31)) for i in range(nb_chunks)]
+    with multiprocessing.Pool(nb_workers) as pool:
+        yield from pool.imap(_generate_lunar_chunk, tasks)
+
+
+def generate_memory(size, game='Pendulum', folder=None, nb_workers=None):
+
+    if game.startswith('Pendulum'):
+        transitions = generate_pendulum_transitions(size)
+    elif game.startswith('LunarLander'):
+        transitions = generate_lunar_transitions(size, nb_workers)
+    else:
+        raise ValueError(f"No transition generator for the game {game}")
+
+    memory = ReplayMemory(size)
+    memory.extend(transitions)
 
-        memory.push(s, a, r, s_, 1 - int(d))
+    # Dump the transitions, to be loaded with train --warm_start
+    if folder is not None:
+        memory.write(folder)
 
     return memory
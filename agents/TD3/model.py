@@ -1,22 +1,27 @@
 import numpy as np
 
 import torch
-import torch.nn.functional as F
 
-from commons.networks import Actor, Critic
+from commons.networks import Actor, EnsembleCritic, soft_update
 from commons.Abstract_Agent import AbstractAgent
 
 
 class TD3(AbstractAgent):
 
+    policy_networks = ('actor.nn',)
+    training_attributes = ('actor.nn', 'actor.target_nn', 'actor.optimizer',
+                           'critics.nn', 'critics.target_nn', 'critics.optimizer', 'update_step')
+
     def __init__(self, device, folder, config):
         super().__init__(device, folder, config)
 
-        self.critic_A = Critic(self.state_size, self.action_size, device, config)
-        self.critic_B = Critic(self.state_size, self.action_size, device, config)
+        # The twin critics (N_CRITICS in general), evaluated and updated together
+        self.critics = EnsembleCritic(self.state_size, self.action_size, device, config)
         self.actor = Actor(self.state_size, self.action_size, device, config)
+        self.set_policy_precision()
 
-        self.update_step = 0
+        # Delayed policy updates
+        self.policy_delay = config.get('POLICY_DELAY', 2)
 
     def select_action(self, state, episode=None, evaluation=False):
         assert (episode is not None) or evaluation
@@ -28,17 +33,20 @@ class TD3(AbstractAgent):
             noise = np.random.normal(scale=self.config['EXPLO_SIGMA'], size=self.action_size)
             return np.clip(action+noise, -1, 1)
 
-    def optimize(self):
+    def select_actions(self, states, episode=None, evaluation=False):
+        assert (episode is not None) or evaluation
+        actions = self.actor.select_actions(states)
+
+        if not evaluation:
+            actions += np.random.normal(scale=self.config['EXPLO_SIGMA'], size=actions.shape)
+        return np.clip(actions, -1, 1, out=actions)
 
-        if len(self.memory) < self.config['BATCH_SIZE']:
-            return {}
+    def update(self, batch, update_policy=True):
 
-        self.update_step += 1
-        states, actions, rewards, next_states, done = self.get_batch()
+        states, actions, rewards, next_states, done = batch
 
-        # Compute Q(s,a) using critic network
-        current_Qa = self.critic_A(states, actions)
-        current_Qb = self.critic_B(states, actions)
+        # Compute Q(s,a) using all the critics at once
+        current_Q = self.critics(states, actions)
 
         # Compute deterministic next state action using actor target network
         next_actions = self.actor.target(next_states)
@@ -46,48 +54,41 @@ class TD3(AbstractAgent):
         noise = noise.clamp(-self.config['UPDATE_CLIP'], self.config['UPDATE_CLIP']).to(self.device)
         next_actions = torch.clamp(next_actions+noise, -1, 1)
 
-        # Compute next state values at t+1 using target critic network
-        target_Qa = self.critic_A.target(next_states, next_actions).detach()
-        target_Qb = self.critic_B.target(next_states, next_actions).detach()
-        target_Q = torch.min(target_Qa, target_Qb)
+        # Compute next state values at t+1 using the minimum of the target critics
+        target_Q = self.critics.target(next_states, next_actions).detach()
 
         # Compute expected state action values y[i]= r[i] + Q'(s[i+1], a[i+1])
         target_Q = rewards + (1 - done) * self.config['GAMMA'] * target_Q
 
-        # loss_critic = F.mse_loss(current_Qa, target_Q) + F.mse_loss(current_Qb, target_Q)
-        loss_critic_A = F.mse_loss(current_Qa, target_Q)
-        loss_critic_B = F.mse_loss(current_Qb, target_Q)
+        # Sum of the losses of the critics
+        loss_critic = self.td_loss(current_Q, target_Q)
 
-        self.critic_A.update(loss_critic_A)
-        self.critic_B.update(loss_critic_B)
+        self.critics.update(loss_critic)
 
-        # Optimize actor every 2 steps
-        if self.update_step % 2 == 0:
-            loss_actor = -self.critic_A(states, self.actor(states)).mean()
+        # Optimize actor every policy_delay updates (cf. AbstractAgent.optimize)
+        if update_policy:
+            loss_actor = -self.critics(states, self.actor(states), index=0).mean()
 
             self.actor.update(loss_actor)
 
-            self.actor.update_target(self.config['TAU'])
-
-            self.critic_A.update_target(self.config['TAU'])
-            self.critic_B.update_target(self.config['TAU'])
+            # Soft parameter update of all the target networks at once
+            soft_update((self.actor, self.critics), self.config['TAU'])
 
-            return {'Q1_loss': loss_critic_A.item(), 'Q2_loss': loss_critic_B.item(),
-                    'actor_loss': loss_actor.item()}
+            return {'critic_loss': loss_critic.item(), 'actor_loss': loss_actor.item()}
 
         else:
-            return {'Q1_loss': loss_critic_A.item(), 'Q2_loss': loss_critic_B.item()}
+            return {'critic_loss': loss_critic.item()}
 
     def save(self):
         print("\033[91m\033[1mModel saved in", self.folder, "\033[0m")
         self.actor.save(self.folder)
-        self.critic_A.save(self.folder)
+        self.critics.save(self.folder)
 
     def load(self, folder=None):
         if folder is None:
             folder = self.folder
         try:
             self.actor.load(folder)
-            self.critic_A.load(folder)
+            self.critics.load(folder)
         except FileNotFoundError:
             raise Exception("No model has been saved !") from None
@@ -0,0 +1,65 @@
+"""Helpers shared by the benchmarks: timing, and agents built from their config without any
+environment to step."""
+import time
+
+import gym
+import numpy as np
+import torch
+
+from commons.envs import register_env
+from commons.plugins import load_agent
+from commons.run_expe import load_config
+
+
+def duration(function, repeats, warmup=10):
+    """Mean duration (in seconds) of a call of function, over repeats calls after warmup ones."""
+    for _ in range(warmup):
+        function()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+class SpacesOnly(gym.Env):
+    """Environment which only gives the observation and action spaces of a benchmark."""
+
+    def __init__(self, config):
+        game = config['GAME']
+        self.observation_space = gym.spaces.Box(-1, 1, shape=(game['state_size'],))
+        if game.get('discrete', False):
+            self.action_space = gym.spaces.Discrete(game['action_size'])
+        else:
+            self.action_space = gym.spaces.Box(-1, 1, shape=(game['action_size'],))
+
+
+def make_agent(name, config, seed=0):
+    """Builds the agent name on the CPU from config, with a plain replay memory in RAM."""
+    config = dict(config, MEMORY_STORAGE='host', PRIORITIZED=False, PREFETCH=0)
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    return load_agent(name)(torch.device('cpu'), None, config)
+
+
+def build_agent(name, state_size, action_size, n_transitions=10000, **options):
+    """Builds the agent name from agents/name/config.yaml (with the options) for the spaces of
+    SpacesOnly, and fills its replay memory with n_transitions random transitions."""
+    register_env('SpacesOnly', SpacesOnly)
+    config = load_config(f'agents/{name}/config.yaml')
+    discrete = name == 'DQN'
+    config['GAME'] = {'id': 'SpacesOnly', 'state_size': state_size, 'action_size': action_size,
+                      'discrete': discrete}
+    config.update(MEMORY_CAPACITY=100000, **options)
+    model = make_agent(name, config)
+
+    n = n_transitions
+    if discrete:
+        actions = np.random.randint(0, action_size, size=n)
+    else:
+        actions = np.random.uniform(-1, 1, size=(n, action_size)).astype(np.float32)
+    model.memory.push_batch(np.random.randn(n, state_size).astype(np.float32), actions,
+                            np.random.randn(n).astype(np.float32),
+                            np.random.randn(n, state_size).astype(np.float32), np.zeros(n, dtype=np.float32))
+    return model
@@ -0,0 +1,51 @@
+"""Latency of the action selection of the policy networks, for batches of 1 to 1024 states.
+
+Compares select_actions (preallocated input buffer, inference mode) with the previous per-call
+path (new FloatTensor and autograd graph at each call). Run with:
+
+    python -m benchmarks.inference_latency [--device cuda] [--repeats 1000]
+"""
+import argparse
+
+import numpy as np
+import torch
+
+from benchmarks.common import duration
+from commons.network_modules import QNetwork, ActorNetwork, SoftActorNetwork
+
+
+def legacy_call(network, states, device):
+    outputs = network(torch.FloatTensor(states).to(device))
+    if isinstance(outputs, tuple):
+        outputs = outputs[0]
+    return outputs.cpu().detach().numpy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the batched action selection')
+    parser.add_argument('--device', default='cpu', type=str)
+    parser.add_argument('--repeats', default=1000, type=int)
+    parser.add_argument('--state_size', default=8, type=int)
+    parser.add_argument('--action_size', default=2, type=int)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    hidden_layers = [400, 300]
+    networks = {
+        'ActorNetwork': ActorNetwork(args.state_size, args.action_size, hidden_layers),
+        'QNetwork': QNetwork(args.state_size, args.action_size, hidden_layers),
+        'SoftActorNetwork': SoftActorNetwork(args.state_size, args.action_size, hidden_layers, device),
+    }
+
+    print(f"{'network':<18}{'batch':>7}{'legacy (us)':>14}{'select_actions (us)':>22}{'speedup':>10}")
+    for name, network in networks.items():
+        network.to(device)
+        for batch_size in 2**np.arange(11):
+            states = np.random.uniform(-1, 1, size=(batch_size, args.state_size))
+            legacy = duration(lambda: legacy_call(network, states, device), args.repeats)
+            batched = duration(lambda: network.select_actions(states), args.repeats)
+            print(f"{name:<18}{batch_size:>7}{1e6*legacy:>14.1f}{1e6*batched:>22.1f}{legacy/batched:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
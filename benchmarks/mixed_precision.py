@@ -0,0 +1,103 @@
+"""Float32 against bfloat16 autocast (MIXED_PRECISION) training of the [400, 300] networks on CPU.
+
+The throughput part times the updates (optimize) and the action selection of DDPG, TD3 and SAC
+built from their config, on a replay memory of random transitions, in both precisions. The
+learning curve part trains the same agent from the same seed in both precisions on a gym
+environment, prints the mean returns per window of episodes, and exits with an error if the
+final mean return of bfloat16 is below the one of float32 by more than --tolerance (relative to
+the range of the float32 returns). Run with:
+
+    python -m benchmarks.mixed_precision [--threads 4] [--updates 300]
+    python -m benchmarks.mixed_precision --learning_curve [--agent DDPG] [--episodes 100]
+"""
+import argparse
+import sys
+
+import numpy as np
+import torch
+
+from benchmarks.common import build_agent, duration, make_agent
+from commons.envs import registry
+from commons.run_expe import load_config
+
+
+def throughput(name, args, mixed_precision):
+    """Returns the updates per second and the duration (ms) of select_actions on a batch."""
+    model = build_agent(name, args.state_size, args.action_size, MIXED_PRECISION=mixed_precision)
+    updates = 1 / duration(model.optimize, args.updates)
+
+    states = np.random.randn(args.envs, args.state_size).astype(np.float32)
+    inference = duration(lambda: model.select_actions(states, evaluation=True), args.updates) * 1e3
+    return updates, inference
+
+
+def learning_curve(args, mixed_precision):
+    """Returns the returns of the training episodes of args.agent."""
+    config = load_config(f'agents/{args.agent}/config.yaml')
+    model = make_agent(args.agent, dict(config, MIXED_PRECISION=mixed_precision), args.seed)
+    env = registry.get(config, 'train')
+    env.seed(args.seed)
+
+    returns = []
+    nb_total_steps = 0
+    for episode in range(args.episodes):
+        state, done, step, episode_return = env.reset(), False, 0, 0
+        while not done and step < config['MAX_STEPS']:
+            action = model.select_action(state, episode=episode)
+            next_state, reward, done, _ = env.step(action)
+            model.memory.push(state, action, reward, next_state, done)
+            model.optimize(model.scheduled_updates(nb_total_steps + 1))
+            state = next_state
+            episode_return += reward
+            step += 1
+            nb_total_steps += 1
+        returns.append(episode_return)
+    return np.array(returns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the bfloat16 autocast training')
+    parser.add_argument('--threads', default=4, type=int, help="Number of threads of torch")
+    parser.add_argument('--updates', default=300, type=int)
+    parser.add_argument('--envs', default=16, type=int, help="Batch of states of select_actions")
+    parser.add_argument('--state_size', default=24, type=int)
+    parser.add_argument('--action_size', default=4, type=int)
+    parser.add_argument('--learning_curve', action='store_true',
+                        help="Compare the learning curves instead of the throughputs")
+    parser.add_argument('--agent', default='DDPG', type=str)
+    parser.add_argument('--episodes', default=100, type=int)
+    parser.add_argument('--window', default=10, type=int, help="Number of episodes per mean return")
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--tolerance', default=0.1, type=float)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+
+    if not args.learning_curve:
+        print(f"{'agent':<7}{'float32 (updates/s)':>21}{'bfloat16 (updates/s)':>22}{'speedup':>10}"
+              f"{'float32 (ms/act)':>18}{'bfloat16 (ms/act)':>19}")
+        for name in ('DDPG', 'TD3', 'SAC'):
+            updates, inference = throughput(name, args, False)
+            updates_bf16, inference_bf16 = throughput(name, args, True)
+            print(f"{name:<7}{updates:>21.1f}{updates_bf16:>22.1f}{updates_bf16/updates:>10.2f}"
+                  f"{inference:>18.3f}{inference_bf16:>19.3f}")
+        return
+
+    returns = learning_curve(args, False)
+    returns_bf16 = learning_curve(args, True)
+
+    print(f"{'episodes':<12}{'float32':>12}{'bfloat16':>12}")
+    for start in range(0, args.episodes, args.window):
+        print(f"{f'{start}-{start+args.window-1}':<12}{returns[start:start+args.window].mean():>12.1f}"
+              f"{returns_bf16[start:start+args.window].mean():>12.1f}")
+
+    final, final_bf16 = returns[-args.window:].mean(), returns_bf16[-args.window:].mean()
+    gap = (final - final_bf16) / max(np.ptp(returns), 1e-8)
+    print(f"Final mean return: {final:.1f} (float32), {final_bf16:.1f} (bfloat16), gap {gap:.1%} of the range")
+    if gap > args.tolerance:
+        print("The bfloat16 training regressed")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Round-trip latency of the policy server, for single and batched requests.
+
+Exports a random ActorNetwork and QNetwork, serves each of them from a separate process on a
+Unix socket, and compares the latency of PolicyClient.act with a direct call of the exported
+module in the client process. Run with:
+
+    python -m benchmarks.policy_server_latency [--repeats 2000]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from benchmarks.common import duration
+from commons.network_modules import ActorNetwork, QNetwork
+from commons.policy_server import PolicyClient, export_policy, load_policy
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the policy server')
+    parser.add_argument('--repeats', default=2000, type=int)
+    parser.add_argument('--state_size', default=8, type=int)
+    parser.add_argument('--action_size', default=2, type=int)
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    networks = {
+        'ActorNetwork': (ActorNetwork(args.state_size, args.action_size, [400, 300]), False),
+        'QNetwork': (QNetwork(args.state_size, args.action_size, [400, 300]), True),
+    }
+
+    print(f"{'policy':<14}{'batch':>7}{'in-process (us)':>17}{'server (us)':>13}{'overhead (us)':>15}")
+    with tempfile.TemporaryDirectory() as folder:
+        for name, (network, discrete) in networks.items():
+            file = os.path.join(folder, f'{name}.pt')
+            socket_path = os.path.join(folder, f'{name}.sock')
+            export_policy(network, args.state_size, args.action_size, discrete, file)
+            module, _ = load_policy(file)
+
+            server = subprocess.Popen([sys.executable, '-m', 'commons.policy_server', file, socket_path],
+                                      stderr=subprocess.DEVNULL)
+            try:
+                while not os.path.exists(socket_path):
+                    time.sleep(0.01)
+
+                with PolicyClient(socket_path) as client:
+                    for batch_size in 2**np.arange(11):
+                        states = np.random.uniform(-1, 1, size=(batch_size, args.state_size)).astype(np.float32)
+                        tensor = torch.from_numpy(states)
+
+                        def local():
+                            with torch.inference_mode():
+                                return module(tensor).numpy()
+
+                        direct = duration(local, args.repeats, warmup=50)
+                        served = duration(lambda: client.act(states), args.repeats, warmup=50)
+                        print(f"{name:<14}{batch_size:>7}{1e6*direct:>17.1f}{1e6*served:>13.1f}"
+                              f"{1e6*(served-direct):>15.1f}")
+            finally:
+                server.terminate()
+                server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Startup time of the command line scripts: train --help and a minimal test run (one episode
+of TD3 on the stand-in CFD environment, without rendering).
+
+Also lists which of the heavy modules each command imports. Run from the root of the
+repository with:
+
+    python -m benchmarks.startup_time [--repeats 5]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+HEAVY_MODULES = ('torch', 'gym', 'matplotlib', 'imageio', 'roboschool', 'cfd')
+
+
+def run(command, repeats):
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        durations.append(time.perf_counter() - start)
+
+    # Modules imported by the command, from the output of -X importtime
+    output = subprocess.run([sys.executable, '-X', 'importtime'] + command[1:], check=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+    imported = {line.rsplit('|', 1)[1].strip().split('.')[0] for line in output.splitlines()
+                if line.startswith('import time:') and '|' in line}
+    return durations, [module for module in HEAVY_MODULES if module in imported]
+
+
+def make_test_folder(folder):
+    """Saves an untrained TD3 agent for the stand-in CFD environment in folder."""
+    from commons.run_expe import load_config
+    from commons.plugins import load_agent
+    import torch
+
+    config = load_config('agents/TD3/config.yaml')
+    config['GAME'] = {'id': 'STARCCMexternalfiles', 'standin': True, 'delay': 0}
+    config['MAX_STEPS'] = 10
+    os.makedirs(f'{folder}/models')
+    with open(f'{folder}/config.yaml', 'w') as file:
+        yaml.dump(config, file)
+    load_agent('TD3')(torch.device('cpu'), folder, config).save()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the startup time of train and test')
+    parser.add_argument('--repeats', default=5, type=int)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        make_test_folder(folder)
+        commands = {
+            'train --help': [sys.executable, 'train', '--help'],
+            'test TD3 -n 1': [sys.executable, 'test', 'TD3', '-f', folder, '--no_render', '-n', '1'],
+        }
+
+        print(f"{'command':<16}{'min (s)':>10}{'median (s)':>12}   heavy modules imported")
+        for name, command in commands.items():
+            durations, modules = run(command, args.repeats)
+            print(f"{name:<16}{min(durations):>10.3f}{statistics.median(durations):>12.3f}   "
+                  f"{', '.join(modules) or '-'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Duration of the whole-network operations of the agents, per parameter against flat buffers.
+
+For the actor and critic of DDPG/TD3 ([400, 300] layers), compares the previous per-parameter
+loops with the operations on the flat parameters (cf. network_modules.flat_parameters): the
+soft update of both target networks, a hard copy of the weights, and a snapshot on the CPU.
+Run with:
+
+    python -m benchmarks.target_update [--device cuda] [--repeats 2000]
+"""
+import argparse
+
+import torch
+
+from benchmarks.common import duration
+from commons.network_modules import flat_parameters
+from commons.networks import Actor, Critic, soft_update
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the target updates on flat parameters')
+    parser.add_argument('--device', default='cpu', type=str)
+    parser.add_argument('--repeats', default=2000, type=int)
+    parser.add_argument('--threads', default=1, type=int, help="Number of threads of torch")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    config = {'HIDDEN_LAYERS': [400, 300], 'LEARNING_RATE_CRITIC': 1e-3, 'LEARNING_RATE_ACTOR': 1e-3}
+    networks = (Actor(8, 2, device, config), Critic(8, 2, device, config))
+    tau = 0.005
+
+    def legacy_soft_update():
+        for network in networks:
+            for target_param, nn_param in zip(network.target_nn.parameters(), network.nn.parameters()):
+                target_param.data.copy_((1-tau)*target_param.data + tau*nn_param.data)
+
+    def legacy_hard_copy():
+        for network in networks:
+            network.target_nn.load_state_dict(network.nn.state_dict())
+
+    def hard_copy():
+        for network in networks:
+            flat_parameters(network.target_nn).copy_(flat_parameters(network.nn))
+
+    def legacy_snapshot():
+        return [{name: value.detach().to('cpu', copy=True) for name, value in network.nn.state_dict().items()}
+                for network in networks]
+
+    def snapshot():
+        return [flat_parameters(network.nn).to('cpu', copy=True) for network in networks]
+
+    operations = {
+        'soft update': (legacy_soft_update, lambda: soft_update(networks, tau)),
+        'hard copy': (legacy_hard_copy, hard_copy),
+        'snapshot': (legacy_snapshot, snapshot),
+    }
+
+    print(f"{'operation':<14}{'per parameter (us)':>20}{'flat (us)':>12}{'speedup':>10}")
+    for name, (legacy, flat) in operations.items():
+        before = duration(legacy, args.repeats)
+        after = duration(flat, args.repeats)
+        print(f"{name:<14}{1e6*before:>20.1f}{1e6*after:>12.1f}{before/after:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
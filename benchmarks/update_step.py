@@ -0,0 +1,50 @@
+"""Training steps per second of DDPG, TD3, SAC and DQN, with the eager and the compiled updates.
+
+Each agent is built from its config (agents/*/config.yaml) for an environment of the given
+sizes, its replay memory is filled with random transitions, and optimize is timed in eager
+mode and with COMPILE set (cf. AbstractAgent.compile_update). One update is done per step,
+so the steps per second are the updates per second of a training whose environment would be
+free. The compilation time (first updates) is reported apart. Run with:
+
+    python -m benchmarks.update_step [--threads 1] [--updates 500] [--backend inductor]
+"""
+import argparse
+import time
+
+import torch
+
+from benchmarks.common import build_agent, duration
+
+
+def steps_per_second(model, updates):
+    """Returns the updates per second and the duration of the first updates (compilation)."""
+    start = time.perf_counter()
+    # Both values of update_policy for TD3, so that all the graphs are compiled
+    for _ in range(4):
+        model.optimize()
+    warmup = time.perf_counter() - start
+    return 1 / duration(model.optimize, updates, warmup=0), warmup
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the eager and compiled update steps')
+    parser.add_argument('--updates', default=500, type=int)
+    parser.add_argument('--threads', default=1, type=int, help="Number of threads of torch")
+    parser.add_argument('--backend', default='inductor', type=str, help="Backend of torch.compile")
+    parser.add_argument('--state_size', default=8, type=int)
+    parser.add_argument('--action_size', default=2, type=int)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+
+    print(f"{'agent':<7}{'eager (steps/s)':>17}{'compiled (steps/s)':>20}{'speedup':>10}{'compile time (s)':>18}")
+    for name in ('DDPG', 'TD3', 'SAC', 'DQN'):
+        eager, _ = steps_per_second(build_agent(name, args.state_size, args.action_size, COMPILE=False),
+                                    args.updates)
+        compiled, warmup = steps_per_second(build_agent(name, args.state_size, args.action_size, COMPILE=True,
+                                                        COMPILE_BACKEND=args.backend), args.updates)
+        print(f"{name:<7}{eager:>17.1f}{compiled:>20.1f}{compiled/eager:>10.2f}{warmup:>18.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,108 +1,385 @@
 from abc import ABC, abstractmethod
 
 import os
-import imageio
-import gym
-try:
-    import roboschool   # noqa: F401
-except ModuleNotFoundError:
-    pass
+import copy
+import operator
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import torch
+import torch.nn.functional as F
 
-from commons.utils import NormalizedActions, ReplayMemory
+from commons.memory import build_memory
+from commons.network_modules import flat_parameters
+from commons.prefetcher import BatchPrefetcher
+from commons.envs import CFD_GAMES, registry, restore_env
+
+# Decorator of the functions left out of the compiled updates (cf. AbstractAgent.compile_update),
+# which does nothing if torch.compile is not available
+run_eagerly = getattr(getattr(torch, 'compiler', None), 'disable', lambda function: function)
+
+# Agent of an evaluation worker process (cf. AbstractAgent.evaluate_parallel)
+_eval_agent = None
+
+
+def _init_eval_worker(agent_class, folder, config):
+    global _eval_agent
+    torch.set_num_threads(1)
+    # The replay memory of the worker agent is never filled
+    config = dict(config, MEMORY_STORAGE='host', MEMORY_CAPACITY=1, PRIORITIZED=False, PREFETCH=0)
+    _eval_agent = agent_class(torch.device('cpu'), folder, config)
+
+
+def _evaluate_episodes(policy_state, n_ep, save_arrays, snapshot):
+    _eval_agent.load_policy_state(policy_state)
+    env = _eval_agent.eval_env
+    rewards = [_eval_agent.run_episode(save_arrays=save_arrays, snapshot=snapshot) for _ in range(n_ep)]
+
+    arrays = None
+    if save_arrays and _eval_agent.config["GAME"]["id"] in CFD_GAMES:
+        arrays = env.arrays_tobesaved()
+    env.close()
+    if _eval_agent.config["GAME"]["id"] == "STARCCMexternalfiles":
+        #end simulation of STARCCM+
+        env.finishCFD(True)
+    return rewards, arrays
+
+
+def _evaluate_score(policy_state, n_ep):
+    _eval_agent.load_policy_state(policy_state)
+    rewards = [_eval_agent.run_episode() for _ in range(n_ep)]
+    _eval_agent.eval_env.close()
+    return float(sum(rewards)/len(rewards))
+
+
+def _cpu_copy(value):
+    """Copies the tensors of a nested state (dicts, lists and tuples) on the CPU."""
+    if isinstance(value, torch.Tensor):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {key: _cpu_copy(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_cpu_copy(item) for item in value)
+    return copy.deepcopy(value)
 
-from cfd.flatplate.flatplate import FlatPlate
-from cfd.starccm.CFDcommunication import CFDcommunication
 
 class AbstractAgent(ABC):
 
+    # Attribute paths of the networks used by select_action (cf. acting_copy)
+    policy_networks = ()
+    # Attribute paths of the whole training state: networks, targets, optimizers, schedulers
+    # and scalars (cf. training_state)
+    training_attributes = ()
+    # Number of updates per update of the policy (cf. optimize)
+    policy_delay = 1
+
     def __init__(self, device, folder, config):
 
         self.folder = folder
         self.config = config
         self.device = device
-        self.memory = ReplayMemory(self.config['MEMORY_CAPACITY'])
 
-        #FLATPLATE/STARCCM/ELLIPSE
-        if config["GAME"]["id"] == "STARCCMexternalfiles":
-            self.eval_env = NormalizedActions(CFDcommunication(config))
-        elif config["GAME"]["id"] == "flatplate":
-            self.eval_env = NormalizedActions(FlatPlate(config))
-        else:
-            self.eval_env = NormalizedActions(gym.make(**self.config['GAME']))
-            
-        self.continuous = bool(self.eval_env.action_space.shape)
+        # The environments are built by the registry, on first use (cf. eval_env)
+        observation_space, action_space = registry.spaces(config)
+        self.continuous = bool(action_space.shape)
 
-        self.state_size = self.eval_env.observation_space.shape[0]
+        self.state_size = observation_space.shape[0]
         if self.continuous:
-            self.action_size = self.eval_env.action_space.shape[0]
+            self.action_size = action_space.shape[0]
         else:
-            self.action_size = self.eval_env.action_space.n
+            self.action_size = action_space.n
 
         self.display_available = 'DISPLAY' in os.environ
 
+        state_bounds = (observation_space.low, observation_space.high)
+        self.memory = build_memory(self.config, self.device, self.folder, state_bounds)
+
+        # Importance-sampling weights and indices of the last batch (prioritized replay only)
+        self.batch_weights = None
+        self.batch_indices = None
+        # Number of updates done, and function running them (cf. optimize)
+        self.update_step = 0
+        self.update_function = None
+        # Forwards and backwards under bfloat16 autocast, with float32 weights (cf. autocast)
+        self.mixed_precision = self.config.get('MIXED_PRECISION', False)
+
+        # Sample the batches in a background thread if PREFETCH (depth of the queue) is set
+        if self.config.get('PREFETCH', 0) > 0:
+            self.prefetcher = BatchPrefetcher(self.memory, self.config['BATCH_SIZE'], self.to_tensors,
+                                              self.config['PREFETCH'])
+        else:
+            self.prefetcher = None
+
+        # Processes of the background evaluations (cf. evaluate_async). A CFD game has a single
+        # solver case, which a second process can not run alongside the training
+        if self.config.get('EVAL_BACKGROUND', False) and self.config["GAME"]["id"] in CFD_GAMES:
+            raise ValueError("The background evaluations (EVAL_BACKGROUND) are not available for the CFD games")
+        self.eval_pool = None
+        self.pending_evaluations = []
+
+    @property
+    def eval_env(self):
+        return registry.get(self.config, 'eval')
+
     @abstractmethod
     def select_action(self, state, episode=None, evaluation=False):
         pass
 
-    def get_batch(self):
+    @abstractmethod
+    def select_actions(self, states, episode=None, evaluation=False):
+        """Selects the actions of a batch of states (one row per environment)."""
+        pass
 
-        transitions = self.memory.sample(self.config['BATCH_SIZE'])
-        batch = list(zip(*transitions))
+    def acting_copy(self):
+        """Returns a shallow copy of the agent whose policy networks are independent copies, to
+        select actions while this agent is optimized (the replay memory is shared)."""
+        clone = copy.copy(self)
+        for path in self.policy_networks:
+            *parents, name = path.split('.')
+            owner = clone
+            for parent in parents:
+                setattr(owner, parent, copy.copy(getattr(owner, parent)))
+                owner = getattr(owner, parent)
+            setattr(owner, name, copy.deepcopy(getattr(owner, name)))
+        return clone
 
-        # Divide memory into different tensors
-        states = torch.FloatTensor(batch[0]).to(self.device)
-        if self.continuous:
-            actions = torch.FloatTensor(batch[1]).to(self.device)
-        else:
-            actions = torch.LongTensor(batch[1]).to(self.device)
-        rewards = torch.FloatTensor(batch[2]).unsqueeze(1).to(self.device)
-        next_states = torch.FloatTensor(batch[3]).to(self.device)
-        done = torch.FloatTensor(batch[4]).unsqueeze(1).to(self.device)
+    def sync_policy(self, source):
+        """Copies the weights of the policy networks of source into this agent."""
+        for path in self.policy_networks:
+            # One copy of the flat parameters (cf. flat_parameters)
+            flat_parameters(operator.attrgetter(path)(self)).copy_(flat_parameters(operator.attrgetter(path)(source)))
+
+    def set_policy_precision(self):
+        """Runs select_action under the autocast of the updates if MIXED_PRECISION is set (to
+        call once the policy networks are built)."""
+        for path in self.policy_networks:
+            operator.attrgetter(path)(self).autocast_dtype = torch.bfloat16 if self.mixed_precision else None
+
+    def autocast(self):
+        """Context of the updates: with MIXED_PRECISION, the forwards (and so their backwards)
+        run in bfloat16 under autocast, while the master weights, the gradients and the
+        optimizer states stay in float32. The losses are computed in float32 by autocast."""
+        return torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=self.mixed_precision)
+
+    def export_policy(self, file):
+        """Saves the policy network alone as a TorchScript module, to be served without the
+        agent (cf. policy_server)."""
+        from commons.policy_server import export_policy
+        network = operator.attrgetter(self.policy_networks[0])(self)
+        export_policy(network, self.state_size, self.action_size, not self.continuous, file)
+
+    def to_tensors(self, batch):
+        states, actions, rewards, next_states, done = batch[:5]
+
+        # Wrap the sampled arrays into tensors, without copy when they are already on the device
+        # Reduced precision values are decoded to float32 once on the device
+        states = self.memory.to_tensor('states', states, self.device)
+        actions = self.memory.to_tensor('actions', actions, self.device)
+        rewards = torch.as_tensor(rewards, device=self.device).unsqueeze(1)
+        next_states = self.memory.to_tensor('next_states', next_states, self.device)
+        done = torch.as_tensor(done, device=self.device).unsqueeze(1)
+
+        if self.memory.prioritized:
+            weights, indices = batch[5:]
+            return states, actions, rewards, next_states, done, \
+                torch.as_tensor(weights, device=self.device).unsqueeze(1), indices
 
         return states, actions, rewards, next_states, done
 
+    def minibatches(self, n_batches):
+        """Yields n_batches batches of tensors (cf. to_tensors), which are views of a single
+        sample of n_batches*BATCH_SIZE transitions converted at once (or the batches of the
+        prefetcher). The sample is taken under the lock of the memory, as the actors of the
+        asynchronous training push transitions concurrently."""
+        if self.prefetcher is not None:
+            for _ in range(n_batches):
+                yield self.prefetcher.get()
+            return
+
+        batch_size = self.config['BATCH_SIZE']
+        with self.memory.lock:
+            batch = self.memory.sample(batch_size, n_batches)
+        batch = self.to_tensors(batch)
+        for i in range(n_batches):
+            yield tuple(values[i*batch_size:(i+1)*batch_size] for values in batch)
+
+    def td_loss(self, current_Q, target_Q, update_priorities=True):
+        """Mean squared TD error of the last batch.
+
+        With a prioritized memory, the errors are weighted by the importance-sampling weights
+        and, if update_priorities is set, used as the new priorities of the sampled transitions.
+
+        current_Q can also hold the values of an ensemble of critics, of shape (n_critics,
+        batch, 1): the loss is then the sum of the losses of the critics, and the priorities
+        are the errors of the first one.
+        """
+        if not self.memory.prioritized:
+            if current_Q.dim() == 2:
+                return F.mse_loss(current_Q, target_Q)
+            return (current_Q - target_Q).pow(2).mean(dim=(1, 2)).sum()
+
+        td_errors = target_Q - current_Q
+        if update_priorities:
+            errors = td_errors if td_errors.dim() == 2 else td_errors[0]
+            self.memory.update_priorities(self.batch_indices, errors.detach().squeeze(1).float().cpu().numpy())
+        return (self.batch_weights * td_errors.pow(2)).mean(dim=(-2, -1)).sum()
+
+    def scheduled_updates(self, step):
+        """Number of updates to run after the environment step number step (from 1): the
+        UPDATES_PER_STEP updates per step are run together every UPDATE_EVERY steps.
+
+        UPDATES_PER_STEP can be fractional: the count is the number of updates due at this step
+        minus the number due at the previous scheduled one, so that the remainders carry over
+        (e.g. 0.5 runs one update every other step)."""
+        update_every = self.config.get('UPDATE_EVERY', 1)
+        if step % update_every != 0:
+            return 0
+        updates_per_step = self.config.get('UPDATES_PER_STEP', 1)
+        # The small offset absorbs the rounding errors of the products (e.g. 3 * 0.1)
+        due = int(step * updates_per_step + 1e-9)
+        return due - int((step - update_every) * updates_per_step + 1e-9)
+
+    def optimize(self, n_updates=1):
+        """Runs n_updates updates back to back, on the minibatches of one sample (cf.
+        minibatches), and returns the losses of the last one (empty if the memory can not give
+        a batch yet, cf. ReplayMemory.can_sample). The policy is updated every policy_delay updates."""
+        if n_updates < 1 or not self.memory.can_sample(self.config['BATCH_SIZE']):
+            return {}
+
+        update = self.update_function or self.compile_update()
+        losses = {}
+        for batch in self.minibatches(n_updates):
+            if self.memory.prioritized:
+                self.batch_weights, self.batch_indices = batch[5:]
+            self.update_step += 1
+            with self.autocast():
+                losses = update(batch[:5], update_policy=self.update_step % self.policy_delay == 0)
+        return losses
+
+    def compile_update(self):
+        """Returns the function running one update: update, or its torch.compile version if
+        COMPILE is set (with the COMPILE_BACKEND backend, 'inductor' by default).
+
+        The whole update is captured (forward, losses, backward and optimizer steps), in
+        several graphs where torch.compile can not go through (e.g. the priorities sent to the
+        memory). The parts which fail to compile run in eager mode, as the whole update if
+        torch.compile is not available.
+        """
+        self.update_function = self.update
+        if self.config.get('COMPILE', False):
+            if not hasattr(torch, 'compile'):
+                print("torch.compile is not available, the updates run in eager mode")
+            else:
+                from torch import _dynamo
+                _dynamo.config.suppress_errors = True
+                self.update_function = torch.compile(self.update, backend=self.config.get('COMPILE_BACKEND', 'inductor'))
+        return self.update_function
+
     @abstractmethod
-    def optimize(self):
+    def update(self, batch, update_policy=True):
+        """Runs one update on a batch of tensors (states, actions, rewards, next_states, done)
+        and returns the losses. update_policy is False for the delayed policy updates."""
         pass
 
-    def evaluate(self, n_ep=1, render=False, gif=False, test=False):
+    def policy_state(self):
+        """Returns a copy on the CPU of the weights of the policy networks."""
+        return {path: {name: value.detach().cpu().clone()
+                       for name, value in operator.attrgetter(path)(self).state_dict().items()}
+                for path in self.policy_networks}
+
+    def load_policy_state(self, state):
+        for path, state_dict in state.items():
+            operator.attrgetter(path)(self).load_state_dict(state_dict)
+
+    def training_state(self):
+        """Returns a copy on the CPU of the training state of the agent (cf.
+        training_attributes), to be saved in a checkpoint while the training goes on."""
+        state = {}
+        for path in self.training_attributes:
+            try:
+                value = operator.attrgetter(path)(self)
+            except AttributeError:
+                # Attributes of an option which is not used (e.g. log_alpha without AUTO_ALPHA)
+                continue
+            if isinstance(value, torch.nn.Module) and next(value.buffers(), None) is None:
+                # One copy of the flat parameters (cf. flat_parameters)
+                state[path] = {'flat_parameters': _cpu_copy(flat_parameters(value))}
+            else:
+                state[path] = _cpu_copy(value.state_dict() if hasattr(value, 'state_dict') else value)
+        return state
+
+    def load_training_state(self, state):
+        for path, value in state.items():
+            current = operator.attrgetter(path)(self)
+            if isinstance(current, torch.nn.Module) and 'flat_parameters' in value:
+                flat_parameters(current).copy_(value['flat_parameters'])
+            elif hasattr(current, 'load_state_dict'):
+                current.load_state_dict(value)
+            elif isinstance(current, torch.Tensor):
+                # In place, since the optimizers hold the tensor
+                with torch.no_grad():
+                    current.copy_(value)
+            else:
+                owner, _, name = path.rpartition('.')
+                setattr(operator.attrgetter(owner)(self) if owner else self, name, value)
+
+    def run_episode(self, render=False, writer=None, save_arrays=False, snapshot=None):
+        """Runs one evaluation episode on eval_env and returns its reward. The episode starts
+        from snapshot (cf. envs.snapshot_env) if given, instead of a reset."""
+        if snapshot is None:
+            state = self.eval_env.reset()
+        else:
+            state = restore_env(self.eval_env, snapshot)
+        reward = 0
+        done = False
+        steps = 0
+        while not done and steps < self.config['MAX_STEPS']:
+            action = self.select_action(state, evaluation=True)
+            if self.config["GAME"]["id"] == "STARCCMexternalfiles":
+                self.eval_env.finishCFD()        
+            state, r, done, _ = self.eval_env.step(action)
+            if render:
+                self.eval_env.render()
+            if writer is not None:
+                writer.append_data(self.eval_env.render(mode='rgb_array'))
+            reward += r
+            if self.config["GAME"]["id"] == "STARCCMexternalfiles":
+                #set as done if the number of maximum steps is reached even if not
+                #reached the final position to avoid the simulation to continue
+                if not done and steps == self.config["MAX_STEPS"] - 1:
+                    done = True                           
+            steps += 1
+
+        if self.config["GAME"]["id"] == "flatplate":
+            self.eval_env.print_won_or_lost(self.eval_env.denormalize_polar_state(state))
+
+        if save_arrays and self.config["GAME"]["id"] in CFD_GAMES:
+            # SAVE variables at the end of episode
+            self.eval_env.fill_array_tobesaved()
+
+        return reward
+
+    def evaluate(self, n_ep=1, render=False, gif=False, test=False, workers=1, snapshot=None):
         rewards = []
         if gif:
+            import imageio
             writer = imageio.get_writer(self.folder + '/results.gif', duration=0.005)
         render = render and self.display_available
+        appli = self.config["GAME"]["id"] in CFD_GAMES
 
         try:
-            for i in range(n_ep):
-                state = self.eval_env.reset()
-                reward = 0
-                done = False
-                steps = 0
-                while not done and steps < self.config['MAX_STEPS']:
-                    action = self.select_action(state, evaluation=True)
-                    if self.config["GAME"]["id"] == "STARCCMexternalfiles":
-                        self.eval_env.finishCFD()        
-                    state, r, done, _ = self.eval_env.step(action)
-                    if render:
-                        self.eval_env.render()
-                    if i == 0 and gif:
-                        writer.append_data(self.eval_env.render(mode='rgb_array'))
-                    reward += r
-                    if self.config["GAME"]["id"] == "STARCCMexternalfiles":
-                        #set as done if the number of maximum steps is reached even if not
-                        #reached the final position to avoid the simulation to continue
-                        if not done and steps == self.config["MAX_STEPS"] - 1:
-                            done = True                           
-                    steps += 1
-                rewards.append(reward)
-             
-                if self.config["GAME"]["id"] == "flatplate":
-                    self.eval_env.print_won_or_lost(self.eval_env.denormalize_polar_state(state))
-
-            if test and args.appli:
-                # SAVE variables at the end of episode
-                self.eval_env.fill_array_tobesaved()
+            parallel = workers > 1 and n_ep > 1 and not (render or gif)
+            if parallel and appli and not hasattr(self.eval_env, 'add_arrays_tobesaved'):
+                print(f"{type(self.eval_env.unwrapped).__name__} can not run in several processes, "
+                      "the evaluation episodes run sequentially")
+                parallel = False
+
+            if parallel:
+                rewards = self.evaluate_parallel(n_ep, workers, save_arrays=test, snapshot=snapshot)
+            else:
+                for i in range(n_ep):
+                    rewards.append(self.run_episode(render, writer if i == 0 and gif else None,
+                                                    save_arrays=test, snapshot=snapshot))
 
         except KeyboardInterrupt:
             if not render:
@@ -116,11 +393,13 @@ class AbstractAgent(ABC):
                 if not os.path.exists(testfolder):
                     os.makedirs(testfolder)
                 # DUMP variables at the end of episode
-                if args.appli:
+                if appli:
                     self.eval_env.print_array_in_files(testfolder)
                     self.eval_env.plot_testing_output(rewards, testfolder)
 
-            self.eval_env.close()
+            # The environment shared with the training is closed at the end of the training
+            if test or not registry.shared(self.config):
+                self.eval_env.close()
 
             if gif:
                 print(f"Saved gif in {self.folder+'/results.gif'}")
@@ -133,6 +412,54 @@ class AbstractAgent(ABC):
         score = sum(rewards)/len(rewards) if rewards else 0
         return score
 
+    def evaluate_parallel(self, n_ep, workers, save_arrays=False, snapshot=None):
+        """Runs n_ep evaluation episodes spread over a pool of processes, and returns their rewards.
+        With a snapshot, all the episodes start from it (e.g. to fan out rollouts from one state).
+
+        Each worker builds its own agent and environment, and receives a copy of the weights of
+        the policy networks. When save_arrays is set, the output arrays of the CFD environments
+        are sent back and added to the ones of eval_env.
+
+        The CFD environments have to provide arrays_tobesaved/add_arrays_tobesaved, as
+        StandInCFD does. FlatPlate and CFDcommunication do not, and drive a single solver
+        case: evaluate runs their episodes sequentially.
+        """
+        chunks = [len(chunk) for chunk in np.array_split(np.arange(n_ep), min(workers, n_ep))]
+        policy_state = self.policy_state()
+
+        with ProcessPoolExecutor(len(chunks), initializer=_init_eval_worker,
+                                 initargs=(type(self), self.folder, self.config)) as pool:
+            results = list(pool.map(_evaluate_episodes, [policy_state]*len(chunks), chunks,
+                                    [save_arrays]*len(chunks), [snapshot]*len(chunks)))
+
+        rewards = []
+        for worker_rewards, arrays in results:
+            rewards.extend(worker_rewards)
+            if arrays is not None:
+                self.eval_env.add_arrays_tobesaved(arrays)
+        return rewards
+
+    def evaluate_async(self, n_ep=1):
+        """Starts the evaluation of the current policy in a background process. The scores are
+        gathered with finished_evaluations, in the order of the calls."""
+        if self.eval_pool is None:
+            self.eval_pool = ProcessPoolExecutor(self.config.get('EVAL_WORKERS', 1), initializer=_init_eval_worker,
+                                                 initargs=(type(self), self.folder, self.config))
+        self.pending_evaluations.append(self.eval_pool.submit(_evaluate_score, self.policy_state(), n_ep))
+
+    def finished_evaluations(self):
+        scores = []
+        while self.pending_evaluations and self.pending_evaluations[0].done():
+            scores.append(self.pending_evaluations.pop(0).result())
+        return scores
+
+    def close_evaluations(self):
+        """Stops the background evaluations, without waiting for the pending ones."""
+        if self.eval_pool is not None:
+            self.eval_pool.shutdown(cancel_futures=True)
+            self.eval_pool = None
+            self.pending_evaluations = []
+
     @abstractmethod
     def save(self):
         pass
@@ -0,0 +1,156 @@
+import os
+import time
+import shutil
+import asyncio
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import gym
+
+
+class AsyncCFDEnv:
+    """Wraps an environment whose steps block on an external solver.
+
+    step_future and reset_future run the blocking calls in a worker thread and return
+    concurrent futures (step_async and reset_async can be awaited instead), so that the agent
+    keeps training while the solver works. step(action) is the blocking step (env.step by
+    default, e.g. run_expe.step_env for the STAR-CCM+ environments). The calls are serialized
+    in a single thread since the solver only runs one simulation at a time. The other
+    attributes are the ones of the wrapped environment.
+    """
+
+    def __init__(self, env, step=None):
+        self.env = env
+        self.step = step or env.step
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def step_future(self, action):
+        return self.executor.submit(self.step, action)
+
+    def reset_future(self):
+        return self.executor.submit(self.env.reset)
+
+    async def step_async(self, action):
+        return await asyncio.wrap_future(self.step_future(action))
+
+    async def reset_async(self):
+        return await asyncio.wrap_future(self.reset_future())
+
+    def __getattr__(self, name):
+        return getattr(self.env, name)
+
+    def close(self):
+        self.executor.shutdown()
+        self.env.close()
+
+
+class StandInCFD(gym.Env):
+    """Pure-Python stand-in of the STAR-CCM+ environment, to test the training loops without
+    the solver.
+
+    Selected with the 'standin' key of the GAME block of the config. Each step writes the
+    result of a 1D point mass pushed toward a target by the action in a file of the exchange
+    folder, from a solver thread and after GAME['delay'] seconds, and waits for this file the
+    way CFDcommunication waits for the output files of STAR-CCM+.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.delay = config['GAME'].get('delay', 1.)
+        self.own_folder = 'exchange_folder' not in config['GAME']
+        self.folder = config['GAME'].get('exchange_folder') or tempfile.mkdtemp(prefix='cfd_standin_')
+        os.makedirs(self.folder, exist_ok=True)
+
+        self.observation_space = gym.spaces.Box(low=-2., high=2., shape=(2,), dtype=np.float32)
+        self.action_space = gym.spaces.Box(low=-1., high=1., shape=(1,), dtype=np.float32)
+        self.dt = 0.1
+        self.target = 1.
+
+        self.state = None
+        self.solver = None
+        self.nb_solver_steps = 0
+
+        self.episode_states = []
+        self.episode_actions = []
+        self.states_tobesaved = []
+        self.actions_tobesaved = []
+
+    def _solve(self, state, action, file_name):
+        position, velocity = state
+        velocity = np.clip(velocity + action[0]*self.dt, -2, 2)
+        position = np.clip(position + velocity*self.dt, -2, 2)
+
+        np.savetxt(file_name + '.tmp', [position, velocity])
+        os.replace(file_name + '.tmp', file_name)
+
+    def step(self, action):
+        action = np.asarray(action, dtype=np.float64).reshape(1)
+        file_name = os.path.join(self.folder, f'result_{self.nb_solver_steps:0>5}.txt')
+        self.nb_solver_steps += 1
+
+        self.solver = threading.Timer(self.delay, self._solve, args=(self.state.copy(), action, file_name))
+        self.solver.start()
+        while not os.path.exists(file_name):
+            time.sleep(0.01)
+        self.state = np.loadtxt(file_name)
+        os.remove(file_name)
+
+        self.episode_states.append(self.state.copy())
+        self.episode_actions.append(action)
+
+        distance = abs(self.state[0] - self.target)
+        return self.state.copy(), -distance, bool(distance < 0.05), {}
+
+    def reset(self):
+        self.state = np.array([-1., 0.])
+        self.episode_states = [self.state.copy()]
+        self.episode_actions = []
+        return self.state.copy()
+
+    def snapshot(self):
+        """Returns the state of the point mass and the trajectory of the episode. The real
+        solver would save its simulation state (e.g. a .sim file) instead."""
+        return self.state.copy(), list(self.episode_states), list(self.episode_actions)
+
+    def restore(self, snapshot):
+        state, episode_states, episode_actions = snapshot
+        self.finishCFD()
+        self.state = state.copy()
+        self.episode_states = list(episode_states)
+        self.episode_actions = list(episode_actions)
+        return self.state.copy()
+
+    def finishCFD(self, final=False):
+        if self.solver is not None:
+            self.solver.join()
+            self.solver = None
+        if final and self.own_folder:
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+    def fill_array_tobesaved(self):
+        self.states_tobesaved.append(np.array(self.episode_states))
+        self.actions_tobesaved.append(np.array(self.episode_actions).reshape(-1, 1))
+
+    def arrays_tobesaved(self):
+        return self.states_tobesaved, self.actions_tobesaved
+
+    def add_arrays_tobesaved(self, arrays):
+        states, actions = arrays
+        self.states_tobesaved.extend(states)
+        self.actions_tobesaved.extend(actions)
+
+    def print_array_in_files(self, folder):
+        for i, (states, actions) in enumerate(zip(self.states_tobesaved, self.actions_tobesaved)):
+            np.savetxt(os.path.join(folder, f'states_{i}.csv'), states, delimiter=';')
+            np.savetxt(os.path.join(folder, f'actions_{i}.csv'), actions, delimiter=';')
+
+    def plot_training_output(self, rewards, folder):
+        import matplotlib.pyplot as plt
+        plt.cla()
+        plt.plot(rewards)
+        plt.savefig(os.path.join(folder, 'standin_rewards.png'))
+        plt.close()
+
+    plot_testing_output = plot_training_output
@@ -0,0 +1,185 @@
+"""Full-state checkpoints of a training run, to resume it exactly.
+
+A checkpoint holds the whole training state of the agent (networks, targets, optimizers and
+scalars, cf. AbstractAgent.training_attributes), the replay memory, the states of the random
+generators (python, NumPy, torch and those of the environments) and the progress of the run
+(next episode, number of steps, rewards). It is a directory folder/checkpoints/episode_XXXXXX
+holding state.pth and memory.npz.
+
+Checkpointer.save copies the state in memory on the training thread and writes it to the disk
+in a background thread, so the training only waits for the copy. The files are written in a
+temporary directory, which is renamed once complete: a crash never leaves a partial
+checkpoint. The resume is exact for the sequential training without PREFETCH (the prefetched
+batches are drawn ahead of the snapshot).
+"""
+import os
+import copy
+import random
+import shutil
+import threading
+
+import numpy as np
+import torch
+
+CHECKPOINT_PREFIX = 'episode_'
+TMP_PREFIX = '.tmp_'
+
+
+def _rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def _set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def snapshot(model, progress, envs=None, memory=True):
+    """Returns copies of the training state and of the replay memory (None if memory is not
+    set), which are not modified by the training afterwards. envs maps names to the
+    environments whose random generator is saved."""
+    state = {
+        'agent': model.training_state(),
+        'rng': _rng_state(),
+        'envs': {name: copy.deepcopy(env.unwrapped.np_random) for name, env in (envs or {}).items()
+                 if getattr(env.unwrapped, 'np_random', None) is not None},
+        'progress': copy.deepcopy(progress),
+    }
+    return state, model.memory.state_dict() if memory else None
+
+
+def _write_file(file_name, write):
+    with open(file_name, 'wb') as file:
+        write(file)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def write_checkpoint(path, state, memory_state=None):
+    """Writes a checkpoint in the directory path, replaced atomically if it exists."""
+    tmp_path = os.path.join(os.path.dirname(path), TMP_PREFIX + os.path.basename(path))
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    _write_file(os.path.join(tmp_path, 'state.pth'), lambda file: torch.save(state, file))
+    if memory_state is not None:
+        _write_file(os.path.join(tmp_path, 'memory.npz'), lambda file: np.savez(file, **memory_state))
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+def list_checkpoints(folder):
+    """Returns the paths of the complete checkpoints of a run folder, from the oldest."""
+    folder = os.path.join(folder, 'checkpoints')
+    if not os.path.isdir(folder):
+        return []
+    return [os.path.join(folder, name) for name in sorted(os.listdir(folder)) if name.startswith(CHECKPOINT_PREFIX)]
+
+
+def find_checkpoint(path):
+    """Returns path if it is a checkpoint, else the last checkpoint of the run folder path."""
+    if os.path.exists(os.path.join(path, 'state.pth')):
+        return path
+    checkpoints = list_checkpoints(path)
+    if not checkpoints:
+        raise FileNotFoundError(f"No checkpoint saved in the folder {path} !")
+    return checkpoints[-1]
+
+
+def load_checkpoint(path):
+    """Reads the training state and the replay memory (None if not saved) of a checkpoint."""
+    # The checkpoint also holds the random generators, which are not only tensors
+    state = torch.load(os.path.join(path, 'state.pth'), map_location='cpu', weights_only=False)
+    memory_file = os.path.join(path, 'memory.npz')
+    memory_state = None
+    if os.path.exists(memory_file):
+        with np.load(memory_file) as arrays:
+            memory_state = dict(arrays)
+    return state, memory_state
+
+
+def restore_checkpoint(model, state, memory_state=None, envs=None):
+    """Puts back the agent, its replay memory and the random generators (of envs too) in the
+    state of a checkpoint, and returns the progress of the run. To be called right before
+    the training loop, since the random generators are restored."""
+    model.load_training_state(state['agent'])
+    if memory_state is not None:
+        model.memory.load_state_dict(memory_state)
+
+    for name, env in (envs or {}).items():
+        if name in state['envs']:
+            env.unwrapped.np_random = copy.deepcopy(state['envs'][name])
+    _set_rng_state(state['rng'])
+    return state['progress']
+
+
+class Checkpointer:
+    """Writes the checkpoints of a run in background, keeping the last keep ones.
+
+    save waits for the previous checkpoint to be written before taking its snapshot, so at
+    most one snapshot is held in memory. An error of the writing thread is raised by the next
+    save or by close.
+    """
+
+    def __init__(self, folder, keep=3, memory=True):
+        self.run_folder = folder
+        self.folder = os.path.join(folder, 'checkpoints')
+        self.keep = keep
+        self.memory = memory
+
+        self.thread = None
+        self.error = None
+
+        # Partial checkpoints of an interrupted run
+        os.makedirs(self.folder, exist_ok=True)
+        for name in os.listdir(self.folder):
+            if name.startswith(TMP_PREFIX):
+                shutil.rmtree(os.path.join(self.folder, name), ignore_errors=True)
+
+    def save(self, model, progress, envs=None):
+        """Snapshots the training state, progress holding at least the next 'episode', and
+        writes it in a background thread."""
+        self.wait()
+        state, memory_state = snapshot(model, progress, envs, self.memory)
+        path = os.path.join(self.folder, f"{CHECKPOINT_PREFIX}{progress['episode']:06d}")
+        self.thread = threading.Thread(target=self._write, args=(path, state, memory_state))
+        self.thread.start()
+
+    def _write(self, path, state, memory_state):
+        try:
+            write_checkpoint(path, state, memory_state)
+            for old_path in list_checkpoints(self.run_folder)[:-self.keep]:
+                shutil.rmtree(old_path, ignore_errors=True)
+        except Exception as error:
+            self.error = error
+
+    def wait(self):
+        """Waits for the checkpoint being written."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        self.wait()
+
+
+def build_checkpointer(config, folder):
+    """Creates the Checkpointer of the config, None if FREQ_CHECKPOINT is not set.
+
+    CHECKPOINT_KEEP is the number of checkpoints kept and CHECKPOINT_MEMORY whether the
+    replay memory is saved in them.
+    """
+    if config.get('FREQ_CHECKPOINT', 0) <= 0:
+        return None
+    return Checkpointer(folder, config.get('CHECKPOINT_KEEP', 3), config.get('CHECKPOINT_MEMORY', True))
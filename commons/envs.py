@@ -0,0 +1,123 @@
+import os
+
+import gym
+#import gym_hypercube
+
+from commons.utils import NormalizedActions
+from commons.plugins import load_plugin
+
+
+# Constructors builder(config) of the environments which are not gym ones, by GAME id. They are
+# given as 'module:name' paths, imported when the environment is built, so that the CFD
+# packages are only needed by the runs which use them
+ENV_BUILDERS = {
+    "STARCCMexternalfiles": 'commons.envs:make_starccm',
+    "flatplate": 'cfd.flatplate.flatplate:FlatPlate',
+    # Gym environments with snapshot/restore methods
+    "PendulumWrapper": 'agents.TD3.env_wrapper:make_pendulum',
+    "LunarWrapper": 'agents.TD3.env_wrapper:make_lunar',
+}
+
+
+def make_starccm(config):
+    if config["GAME"].get("standin"):
+        return load_plugin('commons.cfd_async:StandInCFD')(config)
+    return load_plugin('cfd.starccm.CFDcommunication:CFDcommunication')(config)
+
+
+# Games whose environments are expensive to build (solver, licence): the training and the
+# evaluations share the same environment, and their output arrays are saved
+CFD_GAMES = {"flatplate", "STARCCMexternalfiles"}
+
+
+def register_env(game_id, builder, cfd=False):
+    """Registers the constructor builder(config) (or its 'module:name' path) of the environment
+    of GAME id game_id."""
+    ENV_BUILDERS[game_id] = builder
+    if cfd:
+        CFD_GAMES.add(game_id)
+
+
+def make_env(config):
+    """Builds a new environment, with actions normalized in [-1, 1]."""
+    builder = ENV_BUILDERS.get(config["GAME"]["id"])
+    if builder is None:
+        if config["GAME"]["id"].startswith('Roboschool'):
+            import roboschool   # noqa: F401
+        return NormalizedActions(gym.make(**config['GAME']))
+    if isinstance(builder, str):
+        builder = load_plugin(builder)
+    return NormalizedActions(builder(config))
+
+
+def snapshot_env(env):
+    """Returns a snapshot of the current state of env, to resume it later with restore_env.
+
+    The environment has to implement snapshot() and restore(snapshot), as the Pendulum and
+    LunarLander wrappers of agents/TD3/env_wrapper.py and StandInCFD; this is the hook to
+    implement for the CFD environments.
+    """
+    if not hasattr(env.unwrapped, 'snapshot'):
+        raise NotImplementedError(f"{type(env.unwrapped).__name__} has no snapshot/restore methods")
+    return env.unwrapped.snapshot()
+
+
+def restore_env(env, snapshot):
+    """Puts back env in the state of snapshot, in place, and returns its observation."""
+    if not hasattr(env.unwrapped, 'restore'):
+        raise NotImplementedError(f"{type(env.unwrapped).__name__} has no snapshot/restore methods")
+    return env.unwrapped.restore(snapshot)
+
+
+class EnvRegistry:
+    """Environments of the current process, built on first use and shared by name.
+
+    get(config, 'eval') is the evaluation environment of the agent and of its plotter. The
+    'train' environment of the sequential training is the 'eval' one for the CFD games, since
+    the evaluations only run between the training episodes; the other games get their own.
+    The environments are not inherited by forked processes, which build their own. A shared
+    environment is only closed at the end of the run, not after the evaluations (cf. shared).
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.envs = {}
+
+    def shared(self, config):
+        """Whether the 'eval' environment of the game is also the 'train' one."""
+        return config["GAME"]["id"] in CFD_GAMES
+
+    def _key(self, config, name):
+        if self.shared(config):
+            name = 'eval'
+        return repr(sorted(config["GAME"].items())), name
+
+    def get(self, config, name='eval'):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.envs = {}
+
+        key = self._key(config, name)
+        if key not in self.envs:
+            self.envs[key] = make_env(config)
+        return self.envs[key]
+
+    def close(self, config, name='eval'):
+        """Closes the environment name of the game if it has been built in this process."""
+        if self.pid == os.getpid():
+            env = self.envs.pop(self._key(config, name), None)
+            if env is not None:
+                env.close()
+
+    def spaces(self, config):
+        """Returns the observation and action spaces of the game, without building a second
+        environment if one already exists."""
+        if self.pid == os.getpid():
+            for (game, _), env in self.envs.items():
+                if game == self._key(config, 'eval')[0]:
+                    return env.observation_space, env.action_space
+        env = self.get(config, 'eval')
+        return env.observation_space, env.action_space
+
+
+registry = EnvRegistry()
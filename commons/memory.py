@@ -0,0 +1,525 @@
+import os
+import threading
+
+import yaml
+import numpy as np
+import torch
+
+from commons.transitions import MEMORY_FIELDS, TransitionWriter
+
+
+class Quantizer:
+    """Stores float values with a reduced precision.
+
+    With 'float16', the values are only cast. With 'uint8' or 'uint16', each dimension is
+    mapped affinely from [low, high] to the range of the integer type. decode accepts arrays
+    and tensors, and returns float32 values.
+    """
+
+    def __init__(self, precision, low=None, high=None):
+        self.dtype = np.dtype(precision)
+
+        if np.issubdtype(self.dtype, np.integer):
+            low, high = np.asarray(low, dtype=np.float64), np.asarray(high, dtype=np.float64)
+            if not (np.isfinite(low).all() and np.isfinite(high).all()):
+                raise ValueError(f"The {precision} precision needs finite bounds, use float16 instead")
+            self.max_int = np.iinfo(self.dtype).max
+            self.low = low.astype(np.float32)
+            # The dimensions of constant bounds are stored as 0 (their low value)
+            self.scale = np.where(high > low, (high - low) / self.max_int, 1).astype(np.float32)
+            self.scale_tensors = {}
+
+    def encode(self, values):
+        if not np.issubdtype(self.dtype, np.integer):
+            return np.asarray(values, dtype=self.dtype)
+        return np.clip(np.rint((np.asarray(values) - self.low) / self.scale), 0, self.max_int).astype(self.dtype)
+
+    def decode(self, values):
+        if isinstance(values, torch.Tensor):
+            if not np.issubdtype(self.dtype, np.integer):
+                return values.float()
+            # Cache the parameters on the device of the values
+            if values.device not in self.scale_tensors:
+                self.scale_tensors[values.device] = (torch.as_tensor(self.low, device=values.device),
+                                                     torch.as_tensor(self.scale, device=values.device))
+            low, scale = self.scale_tensors[values.device]
+            return values.float() * scale + low
+
+        if not np.issubdtype(self.dtype, np.integer):
+            return values.astype(np.float32)
+        return values.astype(np.float32) * self.scale + self.low
+
+
+class ReplayMemory:
+    """Ring buffer storing transitions in preallocated typed arrays.
+
+    The arrays are allocated on the first push, once the shapes of the states and actions are
+    known. Sampling returns a tuple of arrays (states, actions, rewards, next_states, done).
+
+    If a folder is given, the arrays are memory-mapped files of folder/memory: they are only
+    paged in RAM when accessed, and flush saves the header describing them so that the
+    memory is opened again with its content when it is created on the same folder.
+
+    With a precision other than float32, the states and the continuous actions are stored
+    encoded by a Quantizer (within state_bounds and [-1, 1] respectively). Sampling then
+    returns the encoded values, to be decoded with decode (cf. AbstractAgent.to_tensors).
+    """
+
+    prioritized = False
+    n_step = 1
+
+    def __init__(self, capacity, folder=None, precision='float32', state_bounds=(None, None)):
+        self.capacity = capacity
+        self.position = 0
+        self.size = 0
+
+        self.precision = precision
+        self.state_bounds = state_bounds
+        self.quantizers = {}
+        if precision != 'float32':
+            self.quantizers['states'] = self.quantizers['next_states'] = Quantizer(precision, *state_bounds)
+            self.quantizers['actions'] = Quantizer(precision, -1, 1)
+
+        self.states = None
+        self.actions = None
+        self.rewards = None
+        self.next_states = None
+        self.done = None
+
+        # Held while writing, and by the readers sampling concurrently (cf. BatchPrefetcher)
+        self.lock = threading.RLock()
+
+        self.folder = None if folder is None else os.path.join(folder, 'memory')
+        if self.folder is not None and os.path.exists(os.path.join(self.folder, 'memory.yaml')):
+            self._open()
+
+    def _arrays(self):
+        return self.states, self.actions, self.rewards, self.next_states, self.done
+
+    def _allocate(self, state, action):
+        state = np.asarray(state)
+        action = np.asarray(action)
+        # Discrete actions are stored as integers to be used as indices
+        if np.issubdtype(action.dtype, np.integer):
+            self.quantizers.pop('actions', None)
+            action_dtype = np.int64
+        else:
+            action_dtype = self.quantizers['actions'].dtype if 'actions' in self.quantizers else np.float32
+        state_dtype = self.quantizers['states'].dtype if 'states' in self.quantizers else np.float32
+
+        self.states = self._empty('states', state.shape, state_dtype)
+        self.actions = self._empty('actions', action.shape, action_dtype)
+        self.rewards = self._empty('rewards', (), np.float32)
+        self.next_states = self._empty('next_states', state.shape, state_dtype)
+        self.done = self._empty('done', (), np.float32)
+
+    def encode(self, name, values):
+        return self.quantizers[name].encode(values) if name in self.quantizers else values
+
+    def decode(self, name, values):
+        """Decodes values of the field name returned by sample (arrays or tensors) to float32."""
+        return self.quantizers[name].decode(values) if name in self.quantizers else values
+
+    def to_tensor(self, name, values, device):
+        """Returns the values of the field name returned by sample as a decoded tensor on device."""
+        if name in self.quantizers and self.quantizers[name].dtype == np.uint16:
+            # No uint16 tensors before torch 2.3: the values are sent as int16 and widened back
+            # on the device
+            values = torch.as_tensor(values.view(np.int16), device=device).int() & 0xFFFF
+        return self.decode(name, torch.as_tensor(values, device=device))
+
+    @property
+    def bytes_per_transition(self):
+        if self.states is None:
+            return None
+        # Tensors only have itemsize from torch 2.1
+        return sum((array.element_size() if isinstance(array, torch.Tensor) else array.itemsize)
+                   * int(np.prod(array.shape[1:])) for array in self._arrays())
+
+    def _empty(self, name, shape, dtype):
+        if self.folder is None:
+            return np.empty((self.capacity, *shape), dtype=dtype)
+
+        os.makedirs(self.folder, exist_ok=True)
+        return np.memmap(os.path.join(self.folder, f'{name}.dat'), dtype=dtype, mode='w+',
+                         shape=(self.capacity, *shape))
+
+    def _open(self, mode='r+'):
+        header = read_memory_header(os.path.dirname(self.folder))
+        if header['capacity'] != self.capacity:
+            raise ValueError(f"The memory saved in {self.folder} has a capacity of {header['capacity']}, "
+                             f"not {self.capacity}")
+        if header.get('precision', 'float32') != self.precision:
+            raise ValueError(f"The memory saved in {self.folder} has a {header['precision']} precision, "
+                             f"not {self.precision}")
+
+        for name in MEMORY_FIELDS:
+            field = header['fields'][name]
+            setattr(self, name, np.memmap(os.path.join(self.folder, f'{name}.dat'), dtype=field['dtype'],
+                                          mode=mode, shape=(self.capacity, *field['shape'])))
+        self.position = header['position']
+        self.size = header['size']
+        if self.actions.dtype == np.int64:
+            self.quantizers.pop('actions', None)
+
+    def flush(self):
+        """Writes the memory-mapped arrays and their header to the disk (if a folder is used)."""
+        if self.folder is None or self.states is None:
+            return
+
+        for array in self._arrays():
+            array.flush()
+
+        header = {'capacity': self.capacity, 'position': self.position, 'size': self.size,
+                  'fields': {name: {'shape': list(array.shape[1:]), 'dtype': array.dtype.name}
+                             for name, array in zip(MEMORY_FIELDS, self._arrays())},
+                  'precision': self.precision,
+                  'state_bounds': [None if bound is None else np.asarray(bound).tolist()
+                                   for bound in self.state_bounds]}
+        # Write then rename, so that a crash never leaves a partial header
+        file_name = os.path.join(self.folder, 'memory.yaml')
+        with open(file_name + '.tmp', 'w') as file:
+            yaml.dump(header, file)
+        os.replace(file_name + '.tmp', file_name)
+
+    def push(self, state, action, reward, next_state, done):
+        with self.lock:
+            if self.states is None:
+                self._allocate(state, action)
+
+            self.states[self.position] = self.encode('states', state)
+            self.actions[self.position] = self.encode('actions', action)
+            self.rewards[self.position] = reward
+            self.next_states[self.position] = self.encode('next_states', next_state)
+            self.done[self.position] = done
+
+            self.position = (self.position + 1) % self.capacity
+            self.size = min(self.size + 1, self.capacity)
+
+    def push_batch(self, states, actions, rewards, next_states, done):
+        """Inserts a batch of transitions at once, with at most two slice copies per array."""
+        transitions = (states, actions, rewards, next_states, done)
+        # Only the last transitions are kept if there are more than the capacity
+        n = min(len(rewards), self.capacity)
+        transitions = tuple(values[len(values)-n:] for values in transitions)
+
+        with self.lock:
+            if self.states is None:
+                self._allocate(states[0], actions[0])
+
+            first = min(n, self.capacity - self.position)
+            for name, array, values in zip(MEMORY_FIELDS, self._arrays(), transitions):
+                values = self.encode(name, values)
+                array[self.position:self.position+first] = values[:first]
+                array[:n-first] = values[first:]
+
+            self.position = (self.position + n) % self.capacity
+            self.size = min(self.size + n, self.capacity)
+
+    def sample_indices(self, batch_size):
+        return np.random.randint(0, self.size, size=batch_size)
+
+    def get(self, indices):
+        return (self.states[indices], self.actions[indices], self.rewards[indices],
+                self.next_states[indices], self.done[indices])
+
+    def sample(self, batch_size, n_batches=1):
+        """Samples n_batches batches at once, concatenated."""
+        return self.get(self.sample_indices(batch_size * n_batches))
+
+    def iter_chunks(self, chunk_size=100000):
+        """Yields the stored one-step transitions in chronological order, by chunks of arrays."""
+        oldest = (self.position - self.size) % self.capacity
+        for start in range(0, self.size, chunk_size):
+            indices = (oldest + np.arange(start, min(start + chunk_size, self.size))) % self.capacity
+            yield tuple(self.decode(name, array[indices]) for name, array in zip(MEMORY_FIELDS, self._arrays()))
+
+    def extend(self, chunks):
+        """Bulk-inserts an iterable of chunks of transitions, as yielded by read_transitions."""
+        for chunk in chunks:
+            self.push_batch(*chunk)
+
+    def load(self, folder, chunk_size=100000):
+        """Fills the memory with the transitions saved in the memory files of a run folder."""
+        header = read_memory_header(folder)
+        saved = ReplayMemory(header['capacity'], precision=header.get('precision', 'float32'),
+                             state_bounds=header.get('state_bounds', (None, None)))
+        saved.folder = os.path.join(folder, 'memory')
+        saved._open(mode='r')
+
+        self.extend(saved.iter_chunks(chunk_size))
+
+    def write(self, folder, chunk_size=100000):
+        """Dumps the transitions in chronological order in the binary format of TransitionWriter."""
+        with TransitionWriter(folder, chunk_size) as writer:
+            for chunk in self.iter_chunks(chunk_size):
+                writer.write_batch(*chunk)
+
+    def state_dict(self):
+        """Returns copies of the stored transitions, in storage order, and of the write position,
+        so that load_state_dict restores the memory exactly (cf. checkpoint)."""
+        with self.lock:
+            state = {'position': self.position, 'size': self.size}
+            if self.states is not None:
+                for name, array in zip(MEMORY_FIELDS, self._arrays()):
+                    if isinstance(array, torch.Tensor):
+                        state[name] = array[:self.size].to('cpu', copy=True).numpy()
+                    else:
+                        state[name] = np.array(array[:self.size])
+        return state
+
+    def load_state_dict(self, state):
+        with self.lock:
+            if 'states' in state:
+                for name in MEMORY_FIELDS:
+                    values = state[name]
+                    if getattr(self, name) is None:
+                        setattr(self, name, self._empty(name, values.shape[1:], values.dtype))
+                    array = getattr(self, name)
+                    array[:len(values)] = values if isinstance(array, np.ndarray) else torch.as_tensor(values)
+                if self.actions.dtype in (np.int64, torch.int64):
+                    self.quantizers.pop('actions', None)
+
+            self.position = int(state['position'])
+            self.size = int(state['size'])
+
+    def __len__(self):
+        return self.size
+
+    def can_sample(self, batch_size):
+        """Whether the memory holds batch_size transitions, each followed by the n_step-1
+        transitions of its return."""
+        return self.size >= batch_size + self.n_step - 1
+
+
+class DeviceReplayMemory(ReplayMemory):
+    """Ring buffer whose storage tensors live on the training device.
+
+    Each push writes one row on the device and the indices are drawn on the device, so a
+    sampled batch never goes through the host. On a CPU device it behaves like ReplayMemory.
+    """
+
+    def __init__(self, capacity, device):
+        super().__init__(capacity)
+        self.device = device
+
+    def _allocate(self, state, action):
+        state = torch.as_tensor(state)
+        action = torch.as_tensor(action)
+        action_dtype = torch.float32 if action.is_floating_point() else torch.int64
+
+        self.states = torch.empty((self.capacity, *state.shape), dtype=torch.float32, device=self.device)
+        self.actions = torch.empty((self.capacity, *action.shape), dtype=action_dtype, device=self.device)
+        self.rewards = torch.empty(self.capacity, dtype=torch.float32, device=self.device)
+        self.next_states = torch.empty((self.capacity, *state.shape), dtype=torch.float32, device=self.device)
+        self.done = torch.empty(self.capacity, dtype=torch.float32, device=self.device)
+
+    def _empty(self, name, shape, dtype):
+        return torch.empty((self.capacity, *shape), dtype=torch.from_numpy(np.empty(0, dtype)).dtype,
+                           device=self.device)
+
+    def push(self, state, action, reward, next_state, done):
+        super().push(torch.as_tensor(state), torch.as_tensor(action), float(reward),
+                     torch.as_tensor(next_state), float(done))
+
+    def push_batch(self, states, actions, rewards, next_states, done):
+        super().push_batch(*(torch.as_tensor(values) for values in (states, actions, rewards, next_states, done)))
+
+    def sample_indices(self, batch_size):
+        return torch.randint(0, self.size, (batch_size,), device=self.device)
+
+    def iter_chunks(self, chunk_size=100000):
+        for chunk in super().iter_chunks(chunk_size):
+            yield tuple(x.cpu().numpy() for x in chunk)
+
+
+class SumTree:
+    """Array-backed binary tree where each node holds the sum of its two children.
+
+    The leaves are stored in tree[capacity:], the root in tree[1]. Updates and searches are
+    done level by level on whole batches of indices, in O(log N) vectorized operations.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = 1 << max(0, int(capacity - 1).bit_length())
+        self.depth = self.capacity.bit_length() - 1
+        self.tree = np.zeros(2 * self.capacity, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def __getitem__(self, indices):
+        return self.tree[np.asarray(indices) + self.capacity]
+
+    def update(self, indices, values):
+        nodes = np.asarray(indices) + self.capacity
+        self.tree[nodes] = values
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """Returns the indices of the leaves where the cumulative sums reach the values."""
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = self.tree[2 * nodes]
+            go_right = values > left
+            values -= left * go_right
+            nodes = 2 * nodes + go_right
+        return nodes - self.capacity
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """Replay memory sampling the transitions proportionally to their priority.
+
+    Cf. Prioritized Experience Replay (Schaul et al., 2015). New transitions get the maximum
+    priority seen so far. Sampling is stratified over the sum of the priorities and returns
+    the importance-sampling weights and the indices needed by update_priorities.
+    """
+
+    prioritized = True
+
+    def __init__(self, capacity, alpha=0.6, beta=0.4, beta_steps=100000, eps=1e-6, **kwargs):
+        super().__init__(capacity, **kwargs)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = (1.0 - beta) / max(1, beta_steps)
+        self.eps = eps
+
+        self.tree = SumTree(capacity)
+        self.max_priority = 1.0
+        # The priorities are not saved with the memory files
+        if self.size > 0:
+            self.tree.update(np.arange(self.size), self.max_priority ** self.alpha)
+
+    def push(self, state, action, reward, next_state, done):
+        with self.lock:
+            self.tree.update([self.position], self.max_priority ** self.alpha)
+            super().push(state, action, reward, next_state, done)
+
+    def push_batch(self, states, actions, rewards, next_states, done):
+        n = min(len(rewards), self.capacity)
+        with self.lock:
+            self.tree.update((self.position + np.arange(n)) % self.capacity, self.max_priority ** self.alpha)
+            super().push_batch(states, actions, rewards, next_states, done)
+
+    def sample_indices(self, batch_size):
+        segment = self.tree.total / batch_size
+        values = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * segment
+        return np.minimum(self.tree.find(values), self.size - 1)
+
+    def sample(self, batch_size, n_batches=1):
+        # Each batch takes one stratum out of n_batches, so that all of them are stratified
+        # over the whole memory
+        indices = self.sample_indices(batch_size * n_batches).reshape(batch_size, n_batches).T.reshape(-1)
+
+        # Importance-sampling weights, normalized by the largest one of each batch, with beta
+        # annealed after each batch
+        probs = (self.tree[indices] / self.tree.total).reshape(n_batches, batch_size)
+        betas = np.minimum(1.0, self.beta + self.beta_increment * np.arange(n_batches))[:, None]
+        weights = (self.size * probs) ** (-betas)
+        weights = (weights / weights.max(axis=1, keepdims=True)).reshape(-1).astype(np.float32)
+        self.beta = min(1.0, self.beta + self.beta_increment * n_batches)
+
+        return (*self.get(indices), weights, indices)
+
+    def update_priorities(self, indices, td_errors):
+        priorities = np.abs(td_errors) + self.eps
+        with self.lock:
+            self.max_priority = max(self.max_priority, float(priorities.max()))
+            self.tree.update(indices, priorities ** self.alpha)
+
+    def state_dict(self):
+        with self.lock:
+            return dict(super().state_dict(), tree=self.tree.tree.copy(), max_priority=self.max_priority,
+                        beta=self.beta)
+
+    def load_state_dict(self, state):
+        with self.lock:
+            super().load_state_dict(state)
+            self.tree.tree[:] = state['tree']
+            self.max_priority = float(state['max_priority'])
+            self.beta = float(state['beta'])
+
+
+class NStepsReplayMemory(ReplayMemory):
+    """Replay memory returning n-steps transitions.
+
+    The one-step transitions are stored as they come and the n-steps returns are computed at
+    sampling time, for the whole batch at once, stopping at the end of the episodes. The
+    n_step attribute can thus be changed at any time without filling the memory again.
+    """
+
+    def __init__(self, capacity, n_step, gamma, **kwargs):
+        super().__init__(capacity, **kwargs)
+        self.n_step = n_step
+        self.gamma = gamma
+
+    def sample_indices(self, batch_size):
+        # Only the transitions followed by n-1 stored transitions can be folded (cf. can_sample)
+        oldest = (self.position - self.size) % self.capacity
+        nb_valid = self.size - self.n_step + 1
+        if nb_valid < 1:
+            raise ValueError(f"The memory holds {self.size} transitions, less than the {self.n_step} of a return")
+        return (oldest + np.random.randint(0, nb_valid, size=batch_size)) % self.capacity
+
+    def get(self, indices):
+        offsets = np.arange(self.n_step)
+        window = (indices[:, None] + offsets) % self.capacity
+        dones = self.done[window]
+
+        # A step counts in the return if the episode has not ended at a previous step
+        alive = np.cumprod(np.concatenate([np.ones((len(indices), 1), dtype=np.float32),
+                                           1 - dones[:, :-1]], axis=1), axis=1)
+        returns = (self.rewards[window] * alive * self.gamma ** offsets).sum(axis=1, dtype=np.float32)
+        last = window[np.arange(len(indices)), alive.sum(axis=1).astype(np.int64) - 1]
+
+        return self.states[indices], self.actions[indices], returns, self.next_states[last], self.done[last]
+
+
+def read_memory_header(folder):
+    """Reads the header of the memory files saved in a run folder."""
+    file_name = os.path.join(folder, 'memory', 'memory.yaml')
+    try:
+        with open(file_name, 'r') as file:
+            return yaml.safe_load(file)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"No memory saved in the folder {folder} !") from None
+
+
+def build_memory(config, device, folder=None, state_bounds=(None, None)):
+    """Creates the replay memory described by the config.
+
+    MEMORY_STORAGE selects where the transitions are stored: 'host' (NumPy arrays, default),
+    'device' (tensors on the training device) or 'disk' (memory-mapped files in the run
+    folder). N_STEP > 1 enables n-steps returns and PRIORITIZED enables prioritized replay
+    (PER_ALPHA, PER_BETA and PER_BETA_STEPS). MEMORY_PRECISION selects how the states and
+    actions are stored: 'float32' (default), 'float16', 'uint8' or 'uint16' (quantized
+    within the state_bounds).
+    """
+    storage = config.get('MEMORY_STORAGE', 'host')
+    n_step = config.get('N_STEP', 1)
+    prioritized = config.get('PRIORITIZED', False)
+    precision = config.get('MEMORY_PRECISION', 'float32')
+
+    if storage == 'device':
+        if n_step > 1 or prioritized or precision != 'float32':
+            raise ValueError("N-steps returns, prioritized replay and reduced precisions are not "
+                             "available with the 'device' memory storage")
+        return DeviceReplayMemory(config['MEMORY_CAPACITY'], device)
+    elif storage in ('host', 'disk'):
+        kwargs = {'folder': folder if storage == 'disk' else None, 'precision': precision,
+                  'state_bounds': state_bounds}
+        if n_step > 1 and prioritized:
+            raise ValueError("N-steps returns can not be combined with prioritized replay")
+        if n_step > 1:
+            return NStepsReplayMemory(config['MEMORY_CAPACITY'], n_step, config['GAMMA'], **kwargs)
+        if prioritized:
+            return PrioritizedReplayMemory(config['MEMORY_CAPACITY'], config.get('PER_ALPHA', 0.6),
+                                           config.get('PER_BETA', 0.4), config.get('PER_BETA_STEPS', 100000),
+                                           **kwargs)
+        return ReplayMemory(config['MEMORY_CAPACITY'], **kwargs)
+    else:
+        raise ValueError(f"Unknown memory storage {storage} (one of {{host, device, disk}})")
@@ -1,9 +1,69 @@
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.distributions import Normal
 
 
-class QNetwork(nn.Module):
+def flat_parameters(module):
+    """Returns a contiguous buffer holding all the parameters of module, which are views of it.
+
+    The parameters are moved into a new buffer on the first call, and again if they do not
+    use it anymore (after .to() or a deep copy of the module). The optimizers keep working on
+    the same Parameter objects. Whole-network operations (Polyak averaging, hard copies,
+    snapshots) are then a single call on the buffer instead of one per parameter.
+    """
+    flat = module.__dict__.get('_flat_parameters')
+    first = next(module.parameters())
+    if flat is None or first.data_ptr() != flat.data_ptr() or first.device != flat.device:
+        params = list(module.parameters())
+        with torch.no_grad():
+            flat = torch.cat([param.detach().reshape(-1) for param in params])
+        offset = 0
+        for param in params:
+            param.data = flat[offset:offset+param.numel()].view_as(param)
+            offset += param.numel()
+        module.__dict__['_flat_parameters'] = flat
+    return flat
+
+
+class BatchedInference:
+    """Mixin of the policy networks, to select actions from NumPy states without allocating
+    their input tensor at each call.
+
+    The states are copied (and cast) into a preallocated input buffer, grown to the next power
+    of two when a larger batch comes, and the network is called in inference mode. The actions
+    are returned as NumPy arrays sharing the memory of the output tensor when it is on the CPU.
+
+    If autocast_dtype is set (e.g. torch.bfloat16, cf. MIXED_PRECISION), the network is called
+    under autocast: the weights stay in float32 and the actions are returned in float32.
+    """
+
+    autocast_dtype = None
+
+    def autocast(self):
+        return torch.autocast(next(self.parameters()).device.type, dtype=self.autocast_dtype or torch.bfloat16,
+                              enabled=self.autocast_dtype is not None)
+
+    def input_tensor(self, states):
+        """Returns the view of the input buffer filled with states, of shape (batch, state_size)."""
+        states = np.asarray(states)
+        states = states.reshape(-1, states.shape[-1])
+        weight = next(self.parameters())
+
+        buffer = self.__dict__.get('input_buffer')
+        if buffer is None or len(buffer) < len(states) or buffer.device != weight.device \
+                or buffer.dtype != weight.dtype:
+            size = 1 << (len(states) - 1).bit_length()
+            with torch.inference_mode():
+                buffer = torch.empty((size, states.shape[1]), dtype=weight.dtype, device=weight.device)
+            self.input_buffer = buffer
+
+        inputs = buffer[:len(states)]
+        inputs.copy_(torch.from_numpy(states))
+        return inputs
+
+
+class QNetwork(BatchedInference, nn.Module):
 
     def __init__(self, input_size, action_size, hidden_layers_size):
         super().__init__()
@@ -18,6 +78,15 @@ class QNetwork(nn.Module):
             x = torch.relu(layer(x))
         return self.output(x)
 
+    def policy(self):
+        return GreedyPolicy(self)
+
+    def select_actions(self, states):
+        """Returns the greedy actions of a batch of states."""
+        with torch.inference_mode(), self.autocast():
+            actions = self(self.input_tensor(states)).argmax(1)
+        return actions.cpu().numpy()
+
     def save(self, file):
         torch.save(self.state_dict(), file)
 
@@ -47,7 +116,73 @@ class CriticNetwork(nn.Module):
         self.load_state_dict(torch.load(file, map_location=device))
 
 
-class ActorNetwork(nn.Module):
+class EnsembleCriticNetwork(nn.Module):
+    """n_critics independent CriticNetworks whose layers are stacked, to evaluate them all with
+    one batched matmul per layer (and update them with a single optimizer).
+
+    The inputs are shared by the critics, of shape (batch, size), or given per critic, of shape
+    (n_critics, batch, size). The values are returned with shape (n_critics, batch, 1), or
+    (batch, 1) for the critic of the given index only. With detach_weights, the gradients only
+    flow to the inputs (e.g. to the actions of an actor loss), not to the weights.
+    """
+
+    def __init__(self, state_size, action_size, hidden_layers_size, n_critics=2):
+        super().__init__()
+        self.n_critics = n_critics
+
+        sizes = [state_size+action_size] + list(hidden_layers_size) + [1]
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        for input_size, output_size in zip(sizes[:-1], sizes[1:]):
+            # Same initialization as nn.Linear, independently for each critic
+            bound = 1 / np.sqrt(input_size)
+            self.weights.append(nn.Parameter(torch.empty(n_critics, input_size, output_size).uniform_(-bound, bound)))
+            self.biases.append(nn.Parameter(torch.empty(n_critics, 1, output_size).uniform_(-bound, bound)))
+
+    def forward(self, state, action, index=None, detach_weights=False):
+        x = torch.cat([state, action], -1)
+        layers = list(zip(self.weights, self.biases))
+        if detach_weights:
+            layers = [(weight.detach(), bias.detach()) for weight, bias in layers]
+
+        if index is not None:
+            for i, (weight, bias) in enumerate(layers):
+                x = torch.matmul(x, weight[index]) + bias[index, 0]
+                if i < len(self.weights) - 1:
+                    x = torch.relu(x)
+            return x
+
+        if x.dim() == 2:
+            x = x.expand(self.n_critics, *x.shape)
+        for i, (weight, bias) in enumerate(layers):
+            x = torch.baddbmm(bias, x, weight)
+            if i < len(self.weights) - 1:
+                x = torch.relu(x)
+        return x
+
+    def load_critic_state(self, state_dict, index=None):
+        """Loads the weights of a CriticNetwork into the critic of index (all if None)."""
+        indices = range(self.n_critics) if index is None else [index]
+        layers = [name[:-len('.weight')] for name in state_dict if name.endswith('.weight')]
+        with torch.no_grad():
+            for weight, bias, layer in zip(self.weights, self.biases, layers):
+                for i in indices:
+                    weight[i].copy_(state_dict[f'{layer}.weight'].t())
+                    bias[i, 0].copy_(state_dict[f'{layer}.bias'])
+
+    def save(self, file):
+        torch.save(self.state_dict(), file)
+
+    def load(self, file, device):
+        state_dict = torch.load(file, map_location=device)
+        # The files of a single CriticNetwork are loaded in all the critics
+        if 'output.weight' in state_dict:
+            self.load_critic_state(state_dict)
+        else:
+            self.load_state_dict(state_dict)
+
+
+class ActorNetwork(BatchedInference, nn.Module):
     def __init__(self, state_size, action_size, hidden_layers_size):
         super().__init__()
         self.hiddens = nn.ModuleList([nn.Linear(state_size, hidden_layers_size[0])])
@@ -60,6 +195,16 @@ class ActorNetwork(nn.Module):
             x = torch.relu(layer(x))
         return torch.tanh(self.output(x))
 
+    def policy(self):
+        return self
+
+    def select_actions(self, states):
+        """Returns the actions of a batch of states (or of a single state)."""
+        with torch.inference_mode(), self.autocast():
+            actions = self(self.input_tensor(states))
+        actions = actions.float().cpu().numpy()
+        return actions if np.ndim(states) > 1 else actions[0]
+
     def save(self, file):
         torch.save(self.state_dict(), file)
 
@@ -88,7 +233,7 @@ class ValueNetwork(nn.Module):
         self.load_state_dict(torch.load(file, map_location=device))
 
 
-class SoftActorNetwork(nn.Module):
+class SoftActorNetwork(BatchedInference, nn.Module):
     def __init__(self, state_size, action_size, hidden_layers_size, device,
                  init_w=3e-3, log_std_min=-20, log_std_max=2):
         super().__init__()
@@ -141,20 +286,45 @@ class SoftActorNetwork(nn.Module):
         std = log_std.exp()
         return mean.cpu().numpy(), std.cpu().numpy()
 
-    def select_action(self, state):
-        state = torch.FloatTensor(state).unsqueeze(0).to(self.device)
-        with torch.no_grad():
-            mean, log_std = self(state)
-            std = log_std.exp()
+    def policy(self):
+        return DeterministicPolicy(self)
 
-            z = self.normal.sample((self.action_size, )).to(self.device)
-            action = torch.tanh(mean + std*z)
+    def select_action(self, state):
+        return self.select_actions(state)
 
-        action = action.cpu().numpy()
-        return action[0]
+    def select_actions(self, states):
+        """Samples the actions of a batch of states (or of a single state)."""
+        with torch.inference_mode(), self.autocast():
+            mean, log_std = self(self.input_tensor(states))
+            actions = torch.tanh(mean + log_std.exp()*torch.randn_like(mean))
+        actions = actions.float().cpu().numpy()
+        return actions if np.ndim(states) > 1 else actions[0]
 
     def save(self, file):
         torch.save(self.state_dict(), file)
 
     def load(self, file, device):
         self.load_state_dict(torch.load(file, map_location=device))
+
+
+class GreedyPolicy(nn.Module):
+    """Greedy actions of a QNetwork, as a module to export (cf. policy_server)."""
+
+    def __init__(self, network):
+        super().__init__()
+        self.network = network
+
+    def forward(self, x):
+        return self.network(x).argmax(1)
+
+
+class DeterministicPolicy(nn.Module):
+    """Actions of the mean of a SoftActorNetwork, as a module to export (cf. policy_server)."""
+
+    def __init__(self, network):
+        super().__init__()
+        self.network = network
+
+    def forward(self, x):
+        mean, _ = self.network(x)
+        return torch.tanh(mean)
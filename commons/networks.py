@@ -2,7 +2,14 @@ import os
 import torch
 import torch.optim as optim
 
-from commons.network_modules import QNetwork, CriticNetwork, ActorNetwork
+from commons.network_modules import QNetwork, CriticNetwork, EnsembleCriticNetwork, ActorNetwork, flat_parameters
+
+
+def soft_update(networks, tau):
+    """Polyak averaging of the target networks of networks (QAgent, Critic, Actor...) at once,
+    with one fused lerp over their flat parameters."""
+    torch._foreach_lerp_([flat_parameters(network.target_nn) for network in networks],
+                         [flat_parameters(network.nn) for network in networks], tau)
 
 
 class QAgent:
@@ -12,7 +19,7 @@ class QAgent:
 
         self.nn = QNetwork(state_size, action_size, config['HIDDEN_LAYERS']).to(self.device)
         self.target_nn = QNetwork(state_size, action_size, config['HIDDEN_LAYERS']).to(self.device)
-        self.target_nn.load_state_dict(self.nn.state_dict())
+        flat_parameters(self.target_nn).copy_(flat_parameters(self.nn))
         self.target_nn.eval()
 
         self.optimizer = optim.Adam(self.nn.parameters(), lr=config['LEARNING_RATE'])
@@ -28,8 +35,7 @@ class QAgent:
         self.scheduler.step()
 
     def update_target(self, tau):
-        for target_param, nn_param in zip(self.target_nn.parameters(), self.nn.parameters()):
-            target_param.data.copy_((1-tau)*target_param.data + tau*nn_param.data)
+        flat_parameters(self.target_nn).lerp_(flat_parameters(self.nn), tau)
 
     def save(self, folder):
         self.nn.save(os.path.join(folder, 'models/dqn.pth'))
@@ -40,9 +46,10 @@ class QAgent:
         self.target_nn.load(os.path.join(folder, 'models/dqn_target.pth'), device=self.device)
 
     def select_action(self, state):
-        with torch.no_grad():
-            state = torch.FloatTensor(state).to(self.device)
-            return self.nn(state).cpu().detach().argmax().item()
+        return self.nn.select_actions(state).item()
+
+    def select_actions(self, states):
+        return self.nn.select_actions(states)
 
     def target(self, state):
         return self.target_nn(state)
@@ -57,7 +64,7 @@ class Critic:
 
         self.nn = CriticNetwork(state_size, action_size, config['HIDDEN_LAYERS']).to(device)
         self.target_nn = CriticNetwork(state_size, action_size, config['HIDDEN_LAYERS']).to(device)
-        self.target_nn.load_state_dict(self.nn.state_dict())
+        flat_parameters(self.target_nn).copy_(flat_parameters(self.nn))
         self.target_nn.eval()
 
         self.optimizer = optim.Adam(self.nn.parameters(), lr=config["LEARNING_RATE_CRITIC"])
@@ -71,8 +78,7 @@ class Critic:
         self.optimizer.step()
 
     def update_target(self, tau):
-        for target_param, nn_param in zip(self.target_nn.parameters(), self.nn.parameters()):
-            target_param.data.copy_((1-tau)*target_param.data + tau*nn_param.data)
+        flat_parameters(self.target_nn).lerp_(flat_parameters(self.nn), tau)
 
     def save(self, folder):
         self.nn.save(os.path.join(folder, 'models/critic.pth'))
@@ -89,13 +95,58 @@ class Critic:
         return self.nn(state, action)
 
 
+class EnsembleCritic:
+    """N_CRITICS critics (2 by default) stacked in one EnsembleCriticNetwork, with one optimizer.
+
+    update takes the sum of the losses of the critics: their gradients are independent, so this
+    is the same as updating each critic with its own loss and optimizer.
+    """
+
+    def __init__(self, state_size, action_size, device, config):
+        self.device = device
+        n_critics = config.get('N_CRITICS', 2)
+
+        self.nn = EnsembleCriticNetwork(state_size, action_size, config['HIDDEN_LAYERS'], n_critics).to(device)
+        self.target_nn = EnsembleCriticNetwork(state_size, action_size, config['HIDDEN_LAYERS'], n_critics).to(device)
+        flat_parameters(self.target_nn).copy_(flat_parameters(self.nn))
+        self.target_nn.eval()
+
+        self.optimizer = optim.Adam(self.nn.parameters(), lr=config["LEARNING_RATE_CRITIC"])
+
+    def update(self, loss, grad_clipping=False):
+        self.optimizer.zero_grad()
+        loss.backward()
+        if grad_clipping:
+            for param in self.nn.parameters():
+                param.grad.data.clamp_(-1, 1)
+        self.optimizer.step()
+
+    def update_target(self, tau):
+        flat_parameters(self.target_nn).lerp_(flat_parameters(self.nn), tau)
+
+    def save(self, folder):
+        self.nn.save(os.path.join(folder, 'models/critic.pth'))
+        self.target_nn.save(os.path.join(folder, 'models/critic_target.pth'))
+
+    def load(self, folder):
+        self.nn.load(os.path.join(folder, 'models/critic.pth'), device=self.device)
+        self.target_nn.load(os.path.join(folder, 'models/critic_target.pth'), device=self.device)
+
+    def target(self, state, action):
+        """Minimum of the target values of the critics."""
+        return self.target_nn(state, action).min(0)[0]
+
+    def __call__(self, state, action, index=None):
+        return self.nn(state, action, index)
+
+
 class Actor:
     def __init__(self, state_size, action_size, device, config):
         self.device = device
 
         self.nn = ActorNetwork(state_size, action_size, config['HIDDEN_LAYERS']).to(device)
         self.target_nn = ActorNetwork(state_size, action_size, config['HIDDEN_LAYERS']).to(device)
-        self.target_nn.load_state_dict(self.nn.state_dict())
+        flat_parameters(self.target_nn).copy_(flat_parameters(self.nn))
         self.target_nn.eval()
 
         self.optimizer = optim.Adam(self.nn.parameters(), lr=config["LEARNING_RATE_ACTOR"])
@@ -109,8 +160,7 @@ class Actor:
         self.optimizer.step()
 
     def update_target(self, tau):
-        for target_param, nn_param in zip(self.target_nn.parameters(), self.nn.parameters()):
-            target_param.data.copy_((1-tau)*target_param.data + tau*nn_param.data)
+        flat_parameters(self.target_nn).lerp_(flat_parameters(self.nn), tau)
 
     def save(self, folder):
         self.nn.save(os.path.join(folder, 'models/actor.pth'))
@@ -121,8 +171,10 @@ class Actor:
         self.target_nn.load(os.path.join(folder, 'models/actor_target.pth'), device=self.device)
 
     def select_action(self, state):
-        state = torch.FloatTensor(state).to(self.device)
-        return self.nn(state).cpu().detach().numpy()
+        return self.nn.select_actions(state)
+
+    def select_actions(self, states):
+        return self.nn.select_actions(states)
 
     def target(self, state):
         return self.target_nn(state)
@@ -3,16 +3,11 @@ import itertools
 import torch
 import numpy as np
 
-import gym
-#import gym_hypercube
-from commons.utils import NormalizedActions
+from commons.envs import registry
 
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 
-from cfd.flatplate.flatplate import FlatPlate
-from cfd.starccm.CFDcommunication import CFDcommunication
-
 class Plotter:
 
     def __init__(self, config, device, folder):
@@ -20,16 +15,13 @@ class Plotter:
         self.folder = folder
         self.config = config
 
-        if config["GAME"]["id"] == "STARCCMexternalfiles":
-            self.eval_env = NormalizedActions(CFDcommunication(config))
-        elif config["GAME"]["id"] == "flatplate":
-            self.eval_env = NormalizedActions(FlatPlate(config))
-        else:
-            self.eval_env = NormalizedActions(gym.make(**config['GAME']))
-
         self.nfig = 1
         self.nfig_actor = 1
 
+    @property
+    def eval_env(self):
+        return registry.get(self.config, 'eval')
+
     def plot_soft_actor_1D(self, soft_actor, pause=False, size=25):
         ss = torch.linspace(-1, 1, size).unsqueeze(1).to(self.device)
         mu, sigma = soft_actor.get_mu_sig(ss)
@@ -120,7 +112,8 @@ class Plotter:
             if pause:
                 self.eval_env.render()
             steps += 1
-        self.eval_env.close()
+        if not registry.shared(self.config):
+            self.eval_env.close()
 
         if not hasattr(self, 'xx'):
             x, y = np.linspace(-1, 1, size), np.linspace(-1, 1, size)
@@ -0,0 +1,26 @@
+import importlib
+
+
+# Agents by name, as 'module:class', imported only when they are used
+AGENTS = {
+    'DDPG': 'agents.DDPG.model:DDPG',
+    'TD3': 'agents.TD3.model:TD3',
+    'SAC': 'agents.SAC.model:SAC',
+    'DQN': 'agents.DQN.model:DQN',
+}
+
+
+def load_plugin(path):
+    """Imports the object of a 'module:name' path."""
+    module, name = path.split(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def register_agent(name, path):
+    AGENTS[name] = path
+
+
+def load_agent(name):
+    if name not in AGENTS:
+        raise Exception(f"Agent invalid (one of {{{', '.join(AGENTS)}}})")
+    return load_plugin(AGENTS[name])
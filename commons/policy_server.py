@@ -0,0 +1,177 @@
+"""Standalone inference of an exported policy, for the controllers of deployed systems.
+
+export_policy writes the policy network alone as a TorchScript module, which only needs torch
+to be loaded. PolicyServer answers the action requests of PolicyClient on a local Unix socket:
+
+    python -m commons.policy_server results/TD3/.../models/policy.pt /tmp/policy.sock
+
+A request is a little-endian uint32 batch size followed by the float32 states; the answer is
+the float32 actions (int64 for a discrete policy). The sizes are sent by the server when a
+client connects, and all the buffers are preallocated for max_batch states.
+"""
+import os
+import sys
+import copy
+import json
+import socket
+import struct
+import argparse
+import threading
+
+import numpy as np
+import torch
+
+HANDSHAKE = struct.Struct('<III')
+REQUEST = struct.Struct('<I')
+
+
+def export_policy(network, state_size, action_size, discrete, file):
+    """Saves the policy of network (cf. its policy method) as a TorchScript module in file."""
+    policy = copy.deepcopy(network.policy()).cpu().eval()
+    with torch.no_grad():
+        module = torch.jit.freeze(torch.jit.trace(policy, torch.zeros(1, state_size)))
+
+    metadata = {'state_size': state_size, 'action_size': action_size, 'discrete': discrete}
+    torch.jit.save(module, file, _extra_files={'policy.json': json.dumps(metadata)})
+
+
+def load_policy(file):
+    """Returns the exported policy module of file and its metadata."""
+    extra_files = {'policy.json': ''}
+    module = torch.jit.load(file, map_location='cpu', _extra_files=extra_files)
+    return module, json.loads(extra_files['policy.json'])
+
+
+def _recv_into(sock, view):
+    while len(view):
+        nbytes = sock.recv_into(view)
+        if nbytes == 0:
+            raise ConnectionError("Connection closed")
+        view = view[nbytes:]
+
+
+class PolicyServer:
+    """Serves the actions of an exported policy on the Unix socket socket_path, one thread per
+    client."""
+
+    def __init__(self, file, socket_path, max_batch=1024):
+        self.policy, self.metadata = load_policy(file)
+        self.socket_path = socket_path
+        self.max_batch = max_batch
+
+        self.sock = None
+        self.stop_event = threading.Event()
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.socket_path)
+        self.sock.listen()
+
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    connection, _ = self.sock.accept()
+                except OSError:
+                    break
+                threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+        finally:
+            self.close()
+
+    def _serve(self, connection):
+        state_size = self.metadata['state_size']
+        discrete = self.metadata['discrete']
+
+        header = bytearray(REQUEST.size)
+        states = np.empty((self.max_batch, state_size), dtype=np.float32)
+        states_tensor = torch.from_numpy(states)
+
+        with connection:
+            connection.sendall(HANDSHAKE.pack(state_size, self.metadata['action_size'], discrete))
+            try:
+                while True:
+                    _recv_into(connection, memoryview(header))
+                    batch_size, = REQUEST.unpack(header)
+                    if batch_size > self.max_batch:
+                        raise ValueError(f"Batch of {batch_size} states larger than {self.max_batch}")
+
+                    _recv_into(connection, memoryview(states[:batch_size]).cast('B'))
+                    with torch.inference_mode():
+                        actions = self.policy(states_tensor[:batch_size])
+                    connection.sendall(actions.numpy())
+            except (ConnectionError, ValueError):
+                pass
+
+    def close(self):
+        self.stop_event.set()
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+
+class PolicyClient:
+    """Requests the actions of batches of states to a PolicyServer."""
+
+    def __init__(self, socket_path, max_batch=1024):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+
+        handshake = bytearray(HANDSHAKE.size)
+        _recv_into(self.sock, memoryview(handshake))
+        self.state_size, self.action_size, self.discrete = HANDSHAKE.unpack(handshake)
+
+        self.request = bytearray(REQUEST.size + 4*max_batch*self.state_size)
+        self.states = np.frombuffer(self.request, dtype=np.float32, offset=REQUEST.size)
+        self.states = self.states.reshape(max_batch, self.state_size)
+        if self.discrete:
+            self.actions = np.empty(max_batch, dtype=np.int64)
+        else:
+            self.actions = np.empty((max_batch, self.action_size), dtype=np.float32)
+
+    def act(self, states):
+        """Returns the actions of states, a single state or a batch. The returned array is
+        overwritten by the next request."""
+        states = np.asarray(states)
+        batch = states.reshape(-1, self.state_size)
+        n = len(batch)
+
+        REQUEST.pack_into(self.request, 0, n)
+        self.states[:n] = batch
+        self.sock.sendall(memoryview(self.request)[:REQUEST.size + 4*n*self.state_size])
+
+        actions = self.actions[:n]
+        _recv_into(self.sock, memoryview(actions).cast('B'))
+        return actions if states.ndim > 1 else actions[0]
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the actions of an exported policy on a Unix socket')
+    parser.add_argument('file', help="TorchScript policy written by export")
+    parser.add_argument('socket', help="Path of the Unix socket")
+    parser.add_argument('--max_batch', default=1024, type=int, help="Maximum number of states of a request")
+    parser.add_argument('--threads', default=1, type=int, help="Number of threads of torch")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    server = PolicyServer(args.file, args.socket, args.max_batch)
+    print(f"Serving {args.file} on {args.socket}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
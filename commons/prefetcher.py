@@ -0,0 +1,83 @@
+import time
+import queue
+import threading
+
+
+class BatchPrefetcher:
+    """Samples batches from a replay memory in a background thread.
+
+    The producer thread keeps a queue of depth ready batches: it samples the memory while
+    holding its lock, so that transitions can be pushed concurrently, then applies convert
+    (e.g. the conversion to tensors on the training device) outside of the lock. get only
+    dequeues a batch, and counts how often the learner had to wait for one.
+    """
+
+    def __init__(self, memory, batch_size, convert, depth=2):
+        self.memory = memory
+        self.batch_size = batch_size
+        self.convert = convert
+
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.error = None
+
+        self.nb_batches = 0
+        self.nb_waits = 0
+        self.wait_time = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    def _produce(self):
+        try:
+            while not self.stop_event.is_set():
+                if not self.memory.can_sample(self.batch_size):
+                    time.sleep(0.001)
+                    continue
+
+                with self.memory.lock:
+                    batch = self.memory.sample(self.batch_size)
+                batch = self.convert(batch)
+
+                while not self.stop_event.is_set():
+                    try:
+                        self.queue.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+        except Exception as error:
+            self.error = error
+
+    def get(self):
+        if self.thread is None:
+            self.start()
+
+        try:
+            batch = self.queue.get_nowait()
+        except queue.Empty:
+            self.nb_waits += 1
+            start = time.time()
+            while True:
+                if self.error is not None:
+                    raise RuntimeError("The batch prefetcher thread failed") from self.error
+                try:
+                    batch = self.queue.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    pass
+            self.wait_time += time.time() - start
+
+        self.nb_batches += 1
+        return batch
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def stats(self):
+        return {'batches': self.nb_batches, 'waits': self.nb_waits,
+                'wait_ratio': self.nb_waits / max(1, self.nb_batches), 'wait_time': self.wait_time}
@@ -1,22 +1,24 @@
 import os
 import signal
 import time
+import threading
 import datetime
+import functools
 import yaml
 try:
     from tqdm import trange
 except ModuleNotFoundError:
     trange = range
 
+import numpy as np
 import torch
-import gym
-#import gym_hypercube
-import matplotlib.pyplot as plt
 
-from commons.utils import NormalizedActions, get_latest_dir
-
-from cfd.flatplate.flatplate import FlatPlate
-from cfd.starccm.CFDcommunication import CFDcommunication
+from commons.utils import get_latest_dir
+from commons.transitions import iter_transitions
+from commons.vec_env import SubprocVecEnv
+from commons.cfd_async import AsyncCFDEnv
+from commons.checkpoint import build_checkpointer, find_checkpoint, load_checkpoint, restore_checkpoint
+from commons.envs import make_env, registry
 
 def load_config(path):
     with open(path, 'r') as file:
@@ -42,158 +44,593 @@ def create_folder(algo_name, game, config):
     return folder
 
 
-def train(Agent, args):
+def end_of_episode(model, config, folder, episode, rewards, lenghts, eval_rewards):
+    """Saves, evaluates and plots the training at the frequencies of the config."""
+    import matplotlib.pyplot as plt
 
-    if args.appli:
-        if args.appli == 'flatplate':
-            print('running flatplate environment')
-            config = load_config(f'cfd/flatplate/config.yaml')
-        elif args.appli == 'starccm':
-            print('running starccm naca012 environment')
-            config = load_config(f'cfd/starccm/config.yaml')
+    if episode % config["FREQ_SAVE"] == 0:
+        model.save()
+        model.memory.flush()
+
+    new_evaluation = False
+    if episode % config["FREQ_EVAL"] == 0:
+        if config.get('EVAL_BACKGROUND', False):
+            # The score is added once the evaluation process is done
+            model.evaluate_async()
         else:
-            print('the CFD environment is not properly defined')
-    else:
-        config = load_config(f'agents/{args.agent}/config.yaml')
+            eval_rewards.append(model.evaluate())
+            new_evaluation = True
 
-    game = config['GAME']['id'].split('-')[0]
-    folder = create_folder(args.agent, game, config)
+    scores = model.finished_evaluations()
+    if scores:
+        eval_rewards.extend(scores)
+        new_evaluation = True
 
-    if args.load:
+    if new_evaluation:
+        plt.cla()
+        plt.title(folder.rsplit('/', 1)[1])
+        absc = range(0, len(eval_rewards*config["FREQ_EVAL"]), config["FREQ_EVAL"])
+        plt.plot(absc, eval_rewards)
+        plt.savefig(f'{folder}/eval_rewards.png')
+
+    if episode % config["FREQ_PLOT"] == 0:
+
+        plt.cla()
+        plt.title(folder.rsplit('/', 1)[1])
+        plt.plot(rewards)
+        plt.savefig(f'{folder}/rewards.png')
+
+        plt.cla()
+        plt.title(folder.rsplit('/', 1)[1])
+        plt.plot(lenghts)
+        plt.savefig(f'{folder}/lenghts.png')
+
+        plt.close()
+
+
+def print_stats(model, nb_total_steps, nb_episodes, time_execution):
+
+    print('---------------------------------------------------\n'
+          '---------------------STATS-------------------------\n'
+          '---------------------------------------------------\n',
+          nb_total_steps, ' steps and updates of the network done\n',
+          nb_episodes, ' episodes done\n'
+          'Execution time : ', round(time_execution, 2), ' seconds\n'
+          '---------------------------------------------------\n'
+          'Average nb of steps per second : ', round(nb_total_steps/time_execution, 3), 'steps/s\n'
+          'Average duration of one episode : ', round(time_execution/max(1, nb_episodes), 3), 's\n'
+          '---------------------------------------------------')
+
+    if model.memory.bytes_per_transition is not None:
+        print('Replay memory : ', len(model.memory), ' transitions of ',
+              model.memory.bytes_per_transition, ' bytes\n'
+              '---------------------------------------------------')
+
+    if model.prefetcher is not None:
+        stats = model.prefetcher.stats()
+        print('Prefetched batches : ', stats['batches'], '\n'
+              'Learner waited on the queue for ', stats['waits'], ' batches (',
+              round(100*stats['wait_ratio'], 1), '%, ', round(stats['wait_time'], 2), ' seconds)\n'
+              '---------------------------------------------------')
+
+
+def end_at_max_steps(config, done, nb_steps):
+    """Sets as done the STAR-CCM+ episodes of nb_steps steps (arrays accepted), even if the final
+    position is not reached, to avoid the simulation to continue."""
+    if config["GAME"]["id"] == "STARCCMexternalfiles":
+        return done | (nb_steps >= config["MAX_STEPS"])
+    return done
+
+
+def step_env(env, config, action):
+    """Steps env, once the previous simulation of STAR-CCM+ is over."""
+    if config["GAME"]["id"] == "STARCCMexternalfiles":
+        env.finishCFD()
+    return env.step(action)
+
+
+def training_episode(model, config, state, episode, step, after_step=None, policy=None, stop=None):
+    """Runs a training episode from state, and returns its reward and its number of steps.
+
+    The actions are selected by policy (the agent by default) and step(action) returns the
+    transition of the environment (e.g. step_env). Each transition is pushed in the memory,
+    then after_step is called (e.g. for the updates). The episode ends when it is done, at
+    MAX_STEPS (cf. end_at_max_steps), or when the stop event is set.
+    """
+    policy = policy or model
+    done = False
+    nb_steps = 0
+    episode_reward = 0
+
+    while not done and nb_steps < config["MAX_STEPS"] and not (stop is not None and stop.is_set()):
+
+        action = policy.select_action(state, episode=episode)
+        next_state, reward, done, _ = step(action)
+        episode_reward += reward
+        nb_steps += 1
+        done = end_at_max_steps(config, done, nb_steps)
+
+        # Save transition into memory
+        model.memory.push(state, action, reward, next_state, done)
+        state = next_state
+
+        if after_step is not None:
+            after_step()
+
+    return episode_reward, nb_steps
+
+
+def overlapped_step(model, env, progress, max_updates, action):
+    """Steps the AsyncCFDEnv env while the agent is optimized on the transitions already in the
+    memory: the scheduled updates (cf. AbstractAgent.scheduled_updates), then more up to
+    max_updates in total if the solver is still busy."""
+    future = env.step_future(action)
+    updates = model.scheduled_updates(progress.nb_total_steps + 1)
+    model.optimize(updates)
+    while updates < max_updates and not future.done():
+        model.optimize()
+        updates += 1
+    return future.result()
+
+
+class TrainingProgress:
+    """Bookkeeping of the episodes of a training, shared by the training loops.
+
+    end_episode records the reward and the length of an episode, runs the end of episode tasks
+    (cf. end_of_episode) and writes a checkpoint every FREQ_CHECKPOINT episodes (cf.
+    commons.checkpoint), with the random generators of envs. With resume, the agent, its
+    memory and the progress are restored from that checkpoint.
+    """
+
+    def __init__(self, model, config, folder, envs=None, resume=None):
+        self.model = model
+        self.config = config
+        self.folder = folder
+        self.envs = envs
+
+        self.rewards = []
+        self.lenghts = []
+        self.eval_rewards = []
+        # Next episode and number of steps of the run, and number of episodes of this process
+        self.first_episode = 0
+        self.nb_total_steps = 0
+        self.nb_episodes = 0
+
+        # Full checkpoints written in background, and exact resume from one
+        self.checkpointer = build_checkpointer(config, folder)
+        if resume:
+            progress = restore_checkpoint(model, *load_checkpoint(resume), envs=envs)
+            self.first_episode = progress['episode']
+            self.nb_total_steps = progress['nb_total_steps']
+            self.rewards, self.lenghts = progress['rewards'], progress['lenghts']
+            self.eval_rewards = progress['eval_rewards']
+            print(f"Resuming {folder} at episode {self.first_episode} from {resume}")
+        self.steps_beginning = self.nb_total_steps
+
+    def end_episode(self, episode, reward, length):
+        self.rewards.append(reward)
+        self.lenghts.append(length)
+        end_of_episode(self.model, self.config, self.folder, episode, self.rewards, self.lenghts, self.eval_rewards)
+        self.nb_episodes += 1
+
+        # At the end of the episode, the state is the one of the start of the next one
+        if self.checkpoint_due(episode):
+            self.checkpointer.save(self.model, {'episode': episode + 1, 'nb_total_steps': self.nb_total_steps,
+                                                'rewards': self.rewards, 'lenghts': self.lenghts,
+                                                'eval_rewards': self.eval_rewards}, self.envs)
+
+    def checkpoint_due(self, episode):
+        """Whether end_episode writes a checkpoint at the end of episode."""
+        return self.checkpointer is not None and episode % self.config["FREQ_CHECKPOINT"] == 0
+
+    def close(self):
+        """Saves the agent and its memory, and stops the background tasks of the training."""
+        self.model.save()
+        self.model.memory.flush()
+        if self.checkpointer is not None:
+            self.checkpointer.close()
+        if self.model.prefetcher is not None:
+            self.model.prefetcher.close()
+        self.model.close_evaluations()
+
+    def print_stats(self, time_execution):
+        print_stats(self.model, self.nb_total_steps - self.steps_beginning, self.nb_episodes, time_execution)
+
+
+def train(Agent, args):
+
+    if args.resume:
+        if args.offline:
+            raise ValueError("An offline training can not be resumed")
+        # The run goes on in its folder, with its config
+        checkpoint = find_checkpoint(args.resume)
+        folder = os.path.dirname(os.path.dirname(checkpoint))
         config = load_config(f'{folder}/config.yaml')
 
+    else:
+        if args.appli:
+            if args.appli == 'flatplate':
+                print('running flatplate environment')
+                config = load_config(f'cfd/flatplate/config.yaml')
+            elif args.appli == 'starccm':
+                print('running starccm naca012 environment')
+                config = load_config(f'cfd/starccm/config.yaml')
+            else:
+                print('the CFD environment is not properly defined')
+        else:
+            config = load_config(f'agents/{args.agent}/config.yaml')
+
+        game = config['GAME']['id'].split('-')[0]
+        folder = create_folder(args.agent, game, config)
+
+        if args.load:
+            config = load_config(f'{folder}/config.yaml')
+
     if args.gpu and torch.cuda.is_available():
         device = torch.device('cuda')
     else:
         device = torch.device('cpu')
     print(f"\033[91m\033[1mDevice : {device}\nFolder : {folder}\033[0m")
 
-    # Create gym environment and agent
-    if config["GAME"]["id"] == "STARCCMexternalfiles":
-        env = NormalizedActions(CFDcommunication(config))
-    elif config["GAME"]["id"] == "flatplate":
-        env = NormalizedActions(FlatPlate(config))
-    else:
-        env = NormalizedActions(gym.make(**config['GAME']))
+    # The n-steps returns are folded over consecutive slots of the memory, which must then hold
+    # the transitions of a single environment in chronological order
+    if config.get('N_STEP', 1) > 1 and (args.num_envs > 1 or args.async_actors > 0):
+        raise ValueError("N-steps returns can not be combined with several environments "
+                         "(--num_envs or --async_actors)")
+
+    # Create agent
     model = Agent(device, folder, config)
 
-    # Load model from a previous run
+    # Load model and replay memory from a previous run
     if args.load:
         model.load(args.load)
+        try:
+            model.memory.load(args.load)
+            print(f"Loaded {len(model.memory)} transitions from {args.load}")
+        except FileNotFoundError as error:
+            print(error)
+
+    # Fill the replay memory with dumped or logged transitions
+    if args.warm_start:
+        model.memory.extend(iter_transitions(args.warm_start, discrete=not model.continuous))
+        print(f"Loaded {len(model.memory)} transitions from {args.warm_start}")
+
+    # Pre-train on a dataset of transitions only, without any environment step
+    if args.offline:
+        model.memory.extend(iter_transitions(args.offline, discrete=not model.continuous))
+        train_offline(model, config, folder, args.offline_steps, args.offline_eval)
+        return
+
+    # Collect transitions in actor threads while a learner thread optimizes the agent
+    if args.async_actors > 0:
+        train_async(model, config, folder, args, checkpoint if args.resume else None)
+        return
+
+    # Step num_envs copies of the environment in subprocesses
+    if args.num_envs > 1:
+        train_vectorized(model, config, folder, args, checkpoint if args.resume else None)
+        return
+
+    # Create gym environment (the evaluation one for the CFD games)
+    env = registry.get(config, 'train')
 
     # Signal to render evaluation during training by pressing CTRL+Z
     def handler(sig, frame):
+        if registry.shared(config):
+            print("The evaluation would interrupt the training episode on the shared environment")
+            return
         model.evaluate(n_ep=1, render=True)
         # model.plot_Q(pause=True)
     signal.signal(signal.SIGTSTP, handler)
 
-    nb_total_steps = 0
-    nb_episodes = 0
+    progress = TrainingProgress(model, config, folder, {'train': env, 'eval': model.eval_env},
+                                checkpoint if args.resume else None)
 
-    print("Starting training...")
-    rewards = []
-    eval_rewards = []
-    lenghts = []
+    step = functools.partial(step_env, env, config)
+    if args.overlap_cfd:
+        # Optimize the agent while the environment (e.g. the CFD solver) computes the steps
+        env = AsyncCFDEnv(env, step)
+        step = functools.partial(overlapped_step, model, env, progress, config.get('OVERLAP_UPDATES', 1))
+
+    def after_step():
+        if not args.overlap_cfd:
+            # The updates scheduled by UPDATES_PER_STEP and UPDATE_EVERY
+            model.optimize(model.scheduled_updates(progress.nb_total_steps + 1))
+        progress.nb_total_steps += 1
+
+    print("Starting training" + (" overlapped with the environment steps..." if args.overlap_cfd else "..."))
     time_beginning = time.time()
+    reset = None
 
     try:
-        for episode in trange(config["MAX_EPISODES"]):
+        for episode in trange(progress.first_episode, config["MAX_EPISODES"]):
 
-            done = False
-            step = 0
-            episode_reward = 0
+            state = reset.result() if reset is not None else env.reset()
+            episode_reward, nb_steps = training_episode(model, config, state, episode, step, after_step)
 
-            state = env.reset()
+            if args.appli:
+                env.fill_array_tobesaved()
 
-            while not done and step < config["MAX_STEPS"]:
+            # With overlap_cfd, the next reset runs during the end of episode tasks, unless they
+            # evaluate on the same environment or snapshot its random generator
+            reset = None
+            if args.overlap_cfd and episode < config["MAX_EPISODES"] - 1 and not registry.shared(config) \
+                    and not progress.checkpoint_due(episode):
+                reset = env.reset_future()
 
-                action = model.select_action(state, episode=episode)
-                
-                if config["GAME"]["id"] == "STARCCMexternalfiles":
-                    env.finishCFD()
-                
-                next_state, reward, done, _ = env.step(action)
-                episode_reward += reward
+            progress.end_episode(episode, episode_reward, nb_steps)
 
-                if config["GAME"]["id"] == "STARCCMexternalfiles":
-                    #set as done if the number of maximum steps is reached even if not
-                    #reached the final position to avoid the simulation to continue
-                    if not done and step == config["MAX_STEPS"] - 1:
-                        done = True
-                
+    except KeyboardInterrupt:
+        pass
 
-                # Save transition into memory
-                model.memory.push(state, action, reward, next_state, done)
-                state = next_state
+    finally:
+        # DUMP variables at the end of training
+        if args.appli:
+            env.print_array_in_files(folder)
+            env.plot_training_output(progress.rewards, folder)
 
-                losses = model.optimize()
+        env.close()
+        progress.close()
+        if config["GAME"]["id"] == "STARCCMexternalfiles":
+            #end simulation of STARCCM+
+            env.finishCFD(True)
 
-                step += 1
-                nb_total_steps += 1
+    progress.print_stats(time.time() - time_beginning)
 
-            rewards.append(episode_reward)
-            lenghts.append(step)
 
-            if args.appli:
-                env.fill_array_tobesaved()
+def train_vectorized(model, config, folder, args, checkpoint=None):
+    """Trains with args.num_envs copies of the environment, stepped in subprocesses.
 
-            if episode % config["FREQ_SAVE"] == 0:
-                model.save()
+    The policy is called once per tick on the batch of states, all the transitions are pushed
+    at once, and the updates scheduled for the transitions of the tick (cf.
+    AbstractAgent.scheduled_updates) are run on a single sample. The episodes of each
+    environment are recorded as they end, and numbered in that order. A resumed run restarts
+    the episodes which were in progress at the checkpoint.
+    """
 
-            if episode % config["FREQ_EVAL"] == 0:
-                eval_rewards.append(model.evaluate())
+    env = SubprocVecEnv(functools.partial(make_env, config), args.num_envs,
+                        model.eval_env.observation_space.shape, model.eval_env.action_space.shape,
+                        sync_cfd=config["GAME"]["id"] == "STARCCMexternalfiles")
 
-                plt.cla()
-                plt.title(folder.rsplit('/', 1)[1])
-                absc = range(0, len(eval_rewards*config["FREQ_EVAL"]), config["FREQ_EVAL"])
-                plt.plot(absc, eval_rewards)
-                plt.savefig(f'{folder}/eval_rewards.png')
+    # The random generators of the environments of the subprocesses are not checkpointed
+    progress = TrainingProgress(model, config, folder, {'eval': model.eval_env}, checkpoint)
 
-            if episode % config["FREQ_PLOT"] == 0:
+    print(f"Starting training with {args.num_envs} environments...")
+    time_beginning = time.time()
 
-                plt.cla()
-                plt.title(folder.rsplit('/', 1)[1])
-                plt.plot(rewards)
-                plt.savefig(f'{folder}/rewards.png')
+    episode_rewards = np.zeros(args.num_envs)
+    steps = np.zeros(args.num_envs, dtype=int)
 
-                plt.cla()
-                plt.title(folder.rsplit('/', 1)[1])
-                plt.plot(lenghts)
-                plt.savefig(f'{folder}/lenghts.png')
+    try:
+        states = env.reset()
 
-                plt.close()
+        episode = progress.first_episode
+        while episode < config["MAX_EPISODES"]:
+
+            actions = model.select_actions(states, episode=episode)
+            next_states, step_rewards, dones = env.step(actions)
+            episode_rewards += step_rewards
+            steps += 1
+            dones = end_at_max_steps(config, dones, steps)
+
+            # Save transitions into memory
+            model.memory.push_batch(states, actions, step_rewards, next_states, dones)
+            states = next_states
+
+            # The updates scheduled for the num_envs steps, on the minibatches of a single sample
+            losses = model.optimize(sum(model.scheduled_updates(progress.nb_total_steps + i)
+                                        for i in range(1, args.num_envs + 1)))
+            progress.nb_total_steps += args.num_envs
 
-            nb_episodes += 1
+            finished = np.flatnonzero(dones | (steps >= config["MAX_STEPS"]))
+            for i in finished:
+                if args.appli:
+                    env.call('fill_array_tobesaved', indices=[i])
+
+                progress.end_episode(episode, episode_rewards[i], steps[i])
+                episode += 1
+
+            if len(finished) > 0:
+                states[finished] = env.reset(finished)
+                episode_rewards[finished] = 0
+                steps[finished] = 0
 
     except KeyboardInterrupt:
         pass
 
     finally:
-        # DUMP variables at the end of training
-        if args.appli:
-            env.print_array_in_files(folder)
-            env.plot_training_output(rewards, folder)
+        # DUMP variables of each environment at the end of training
+        for i in range(args.num_envs):
+            if args.appli:
+                os.makedirs(f'{folder}/env_{i}', exist_ok=True)
+                env.call('print_array_in_files', f'{folder}/env_{i}', indices=[i])
+            if config["GAME"]["id"] == "STARCCMexternalfiles":
+                #end simulation of STARCCM+
+                env.call('finishCFD', True, indices=[i])
 
         env.close()
-        model.save()
-        if config["GAME"]["id"] == "STARCCMexternalfiles":
-            #end simulation of STARCCM+
-            env.finishCFD(True)
+        progress.close()
+        # The evaluation environment of the CFD games is left open by the evaluations
+        if registry.shared(config):
+            registry.close(config)
+
+    progress.print_stats(time.time() - time_beginning)
+
+
+def train_async(model, config, folder, args, checkpoint=None):
+    """Trains with args.async_actors actor threads and one learner thread.
+
+    Each actor steps its own environment with a copy of the policy, refreshed every
+    POLICY_SYNC of its steps, and pushes its transitions in the shared replay memory. The
+    learner calls optimize continuously, but waits when it has done more than UPDATE_TO_DATA
+    updates per collected transition. The end of episode tasks (save, evaluation, plots,
+    checkpoints) pause the learner. A resumed run restarts the episodes which were in
+    progress at the checkpoint.
+    """
+
+    update_to_data = config.get('UPDATE_TO_DATA', 1)
+    policy_sync = config.get('POLICY_SYNC', 100)
+
+    learner_lock = threading.Lock()
+    counters_lock = threading.Lock()
+    stop = threading.Event()
+    errors = []
+
+    envs = [make_env(config) for _ in range(args.async_actors)]
+    progress = TrainingProgress(model, config, folder, {'eval': model.eval_env}, checkpoint)
+    counters = {'updates': 0, 'started': progress.first_episode}
+
+    def actor(env):
+        # The weights are not copied in the middle of an update
+        with learner_lock:
+            policy = model.acting_copy()
+        steps_since_sync = 0
+
+        def after_step():
+            nonlocal steps_since_sync
+            steps_since_sync += 1
+            if steps_since_sync >= policy_sync:
+                with learner_lock:
+                    policy.sync_policy(model)
+                steps_since_sync = 0
+            with counters_lock:
+                progress.nb_total_steps += 1
+
+        try:
+            while not stop.is_set():
+                with counters_lock:
+                    if counters['started'] >= config["MAX_EPISODES"]:
+                        break
+                    episode = counters['started']
+                    counters['started'] += 1
+
+                episode_reward, nb_steps = training_episode(model, config, env.reset(), episode,
+                                                            functools.partial(step_env, env, config),
+                                                            after_step, policy, stop)
+                if stop.is_set():
+                    break
+
+                if args.appli:
+                    env.fill_array_tobesaved()
+
+                with learner_lock:
+                    progress.end_episode(episode, episode_reward, nb_steps)
+
+        except Exception as error:
+            errors.append(error)
+            stop.set()
+
+    def learner():
+        try:
+            while not stop.is_set():
+                with counters_lock:
+                    transitions = progress.nb_total_steps - progress.steps_beginning
+                    waiting = counters['updates'] >= update_to_data * transitions
+                if waiting:
+                    time.sleep(0.001)
+                    continue
+
+                with learner_lock:
+                    losses = model.optimize()
+                if losses:
+                    with counters_lock:
+                        counters['updates'] += 1
+                else:
+                    # Not enough transitions in the memory yet
+                    time.sleep(0.001)
+
+        except Exception as error:
+            errors.append(error)
+            stop.set()
+
+    print(f"Starting training with {args.async_actors} asynchronous actors...")
+    time_beginning = time.time()
+    learner_thread = threading.Thread(target=learner, daemon=True)
+    actor_threads = [threading.Thread(target=actor, args=(env,), daemon=True) for env in envs]
 
-    time_execution = time.time() - time_beginning
+    try:
+        learner_thread.start()
+        for thread in actor_threads:
+            thread.start()
+        for thread in actor_threads:
+            while thread.is_alive():
+                thread.join(timeout=0.5)
 
-    print('---------------------------------------------------\n'
-          '---------------------STATS-------------------------\n'
-          '---------------------------------------------------\n',
-          nb_total_steps, ' steps and updates of the network done\n',
-          nb_episodes, ' episodes done\n'
-          'Execution time : ', round(time_execution, 2), ' seconds\n'
-          '---------------------------------------------------\n'
-          'Average nb of steps per second : ', round(nb_total_steps/time_execution, 3), 'steps/s\n'
-          'Average duration of one episode : ', round(time_execution/max(1, nb_episodes), 3), 's\n'
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        stop.set()
+        for thread in actor_threads + [learner_thread]:
+            thread.join()
+
+        # DUMP variables of each environment at the end of training
+        for i, env in enumerate(envs):
+            if args.appli:
+                os.makedirs(f'{folder}/actor_{i}', exist_ok=True)
+                env.print_array_in_files(f'{folder}/actor_{i}')
+            env.close()
+            if config["GAME"]["id"] == "STARCCMexternalfiles":
+                #end simulation of STARCCM+
+                env.finishCFD(True)
+
+        progress.close()
+        # The evaluation environment of the CFD games is left open by the evaluations
+        if registry.shared(config):
+            registry.close(config)
+
+    if errors:
+        raise errors[0]
+
+    time_execution = time.time() - time_beginning
+    transitions = progress.nb_total_steps - progress.steps_beginning
+    progress.print_stats(time_execution)
+    print('Actors throughput : ', round(transitions/time_execution, 3), ' transitions/s\n'
+          'Learner throughput : ', round(counters['updates']/time_execution, 3), ' updates/s\n'
           '---------------------------------------------------')
 
 
+def train_offline(model, config, folder, nb_steps, freq_eval):
+    """Runs nb_steps gradient steps on the transitions of the replay memory, and evaluates the
+    agent every freq_eval steps."""
+    import matplotlib.pyplot as plt
+
+    print(f"Starting offline training on {len(model.memory)} transitions...")
+    eval_rewards = []
+    time_beginning = time.time()
+
+    try:
+        for step in trange(1, nb_steps+1):
+
+            model.optimize()
+
+            if step % freq_eval == 0:
+                eval_rewards.append(model.evaluate())
+                model.save()
+
+                plt.cla()
+                plt.title(folder.rsplit('/', 1)[1])
+                plt.plot(range(freq_eval, len(eval_rewards)*freq_eval+1, freq_eval), eval_rewards)
+                plt.xlabel('Gradient steps')
+                plt.savefig(f'{folder}/eval_rewards.png')
+                plt.close()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        model.save()
+        if model.prefetcher is not None:
+            model.prefetcher.close()
+        model.close_evaluations()
+        # The evaluation environment of the CFD games is left open by the evaluations
+        if registry.shared(config):
+            registry.close(config)
+
+    time_execution = time.time() - time_beginning
+    print(f"Offline training done in {round(time_execution, 2)} seconds")
+
+
 def test(Agent, args):
 
     if args.folder is None:
@@ -210,5 +647,21 @@ def test(Agent, args):
     model = Agent(device, args.folder, config)
     model.load()
 
-    score = model.evaluate(n_ep=args.nb_tests, render=args.render, gif=args.gif, test=True)
+    score = model.evaluate(n_ep=args.nb_tests, render=args.render, gif=args.gif, test=True, workers=args.workers)
     print(f"Average score : {score}")
+
+
+def export(Agent, args):
+
+    if args.folder is None:
+        agent_folder = f'results/{args.agent}'
+        args.folder = os.path.join(get_latest_dir(agent_folder))
+
+    config = load_config(os.path.join(args.folder, 'config.yaml'))
+
+    model = Agent(torch.device('cpu'), args.folder, config)
+    model.load()
+
+    output = args.output or os.path.join(args.folder, 'models/policy.pt')
+    model.export_policy(output)
+    print(f"Exported the policy of \033[91m\033[1m{args.agent}\033[0m saved in {args.folder} to {output}")
@@ -0,0 +1,134 @@
+import os
+import re
+
+import yaml
+import numpy as np
+
+
+MEMORY_FIELDS = ('states', 'actions', 'rewards', 'next_states', 'done')
+
+
+class TransitionWriter:
+    """Streaming writer of transitions in a chunked binary format.
+
+    The transitions are buffered and written in folder/shard_XXXXX.npz files of chunk_size
+    transitions, one array per field. folder/header.yaml lists the shards with the shapes and
+    dtypes of the fields, and is rewritten after each shard so that the dump stays readable
+    if the writing process is interrupted.
+    """
+
+    def __init__(self, folder, chunk_size=100000, compress=False):
+        self.folder = folder
+        self.chunk_size = chunk_size
+        self.save = np.savez_compressed if compress else np.savez
+
+        self.buffer = []
+        self.nb_buffered = 0
+        self.header = {'nb_transitions': 0, 'fields': None, 'shards': []}
+
+        os.makedirs(folder, exist_ok=True)
+
+    def write(self, state, action, reward, next_state, done):
+        self.write_batch(*(np.asarray(x)[None] for x in (state, action, reward, next_state, done)))
+
+    def write_batch(self, states, actions, rewards, next_states, done):
+        self.buffer.append((states, actions, rewards, next_states, done))
+        self.nb_buffered += len(rewards)
+        while self.nb_buffered >= self.chunk_size:
+            self._write_shard(self.chunk_size)
+
+    def _write_shard(self, size):
+        chunk = [np.concatenate(values) for values in zip(*self.buffer)]
+        self.buffer = [tuple(values[size:] for values in chunk)] if len(chunk[2]) > size else []
+        self.nb_buffered -= size
+
+        if self.header['fields'] is None:
+            self.header['fields'] = {name: {'shape': list(values.shape[1:]), 'dtype': values.dtype.name}
+                                     for name, values in zip(MEMORY_FIELDS, chunk)}
+
+        shard = f"shard_{len(self.header['shards']):0>5}.npz"
+        self.save(os.path.join(self.folder, shard),
+                  **{name: values[:size] for name, values in zip(MEMORY_FIELDS, chunk)})
+        self.header['shards'].append(shard)
+        self.header['nb_transitions'] += size
+        self._write_header()
+
+    def _write_header(self):
+        file_name = os.path.join(self.folder, 'header.yaml')
+        with open(file_name + '.tmp', 'w') as file:
+            yaml.dump(self.header, file)
+        os.replace(file_name + '.tmp', file_name)
+
+    def close(self):
+        if self.nb_buffered > 0:
+            self._write_shard(self.nb_buffered)
+        elif not self.header['shards']:
+            self._write_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_transitions(folder):
+    """Yields the chunks of transitions (states, actions, rewards, next_states, done) of a
+    binary dump, one shard at a time."""
+    try:
+        with open(os.path.join(folder, 'header.yaml'), 'r') as file:
+            header = yaml.safe_load(file)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"No transitions saved in the folder {folder} !") from None
+
+    for shard in header['shards']:
+        with np.load(os.path.join(folder, shard)) as data:
+            yield tuple(data[name] for name in MEMORY_FIELDS)
+
+
+def read_csv_transitions(file_name, chunk_size=100000, discrete=False):
+    """Yields the transitions logged by utils.write_transitions, by chunks of chunk_size.
+
+    Each line is '[s] ; [a] ; r ; [s_] ; 1-done'. Only one chunk is held in memory at a time.
+    With discrete, the actions are returned as int64 indices of shape (n,), as the replay
+    memory stores them for the discrete agents (DQN).
+    """
+    def parse_list(field):
+        # Logs written with NumPy 2 scalars contain reprs such as np.float64(0.5)
+        field = re.sub(r'np\.\w+\(([^)]*)\)', r'\1', field.strip())
+        return np.array(field[1:-1].split(','), dtype=np.float32)
+
+    def parse_actions(fields):
+        actions = np.stack([parse_list(f[1]) for f in fields])
+        return np.rint(actions[:, 0]).astype(np.int64) if discrete else actions
+
+    def to_arrays(lines):
+        fields = [line.split(' ; ') for line in lines]
+        return (np.stack([parse_list(f[0]) for f in fields]),
+                parse_actions(fields),
+                np.array([f[2] for f in fields], dtype=np.float32),
+                np.stack([parse_list(f[3]) for f in fields]),
+                1 - np.array([f[4] for f in fields], dtype=np.float32))
+
+    lines = []
+    with open(file_name, 'r') as file:
+        for line in file:
+            if line.strip():
+                lines.append(line)
+            if len(lines) == chunk_size:
+                yield to_arrays(lines)
+                lines = []
+    if lines:
+        yield to_arrays(lines)
+
+
+def iter_transitions(path, chunk_size=100000, discrete=False):
+    """Streams the transitions of a binary dump folder or of a CSV file, by chunks of at most
+    chunk_size transitions. discrete is given to read_csv_transitions (the binary dumps keep
+    the dtype of the actions)."""
+    if os.path.isdir(path):
+        for chunk in read_transitions(path):
+            for start in range(0, len(chunk[2]), chunk_size):
+                yield tuple(values[start:start+chunk_size] for values in chunk)
+    else:
+        yield from read_csv_transitions(path, chunk_size, discrete)
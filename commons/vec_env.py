@@ -0,0 +1,93 @@
+import multiprocessing
+
+import numpy as np
+
+
+def _as_arrays(shared, shapes):
+    return [np.frombuffer(array, dtype=np.float64).reshape(shape) for array, shape in zip(shared, shapes)]
+
+
+def _worker(remote, env_fn, index, shared, shapes, sync_cfd):
+    env = env_fn()
+    observations, actions, rewards, dones = _as_arrays(shared, shapes)
+
+    while True:
+        command, data = remote.recv()
+        try:
+            if command == 'step':
+                action = actions[index]
+                if env.action_space.shape == ():
+                    action = int(action[0])
+                if sync_cfd:
+                    env.finishCFD()
+                observations[index], rewards[index], dones[index], _ = env.step(action)
+                result = None
+            elif command == 'reset':
+                observations[index] = env.reset()
+                result = None
+            elif command == 'call':
+                name, args = data
+                result = getattr(env, name)(*args)
+            elif command == 'close':
+                env.close()
+                remote.send(None)
+                break
+            remote.send(result)
+        except Exception as error:
+            remote.send(error)
+
+
+class SubprocVecEnv:
+    """Runs num_envs copies of an environment, each one in its own process.
+
+    The observations, actions, rewards and done flags are exchanged through shared-memory
+    arrays with one row per environment; the pipes only carry the commands. step and reset
+    return copies of the rows of the stepped/reset environments.
+    """
+
+    def __init__(self, env_fn, num_envs, observation_shape, action_shape, sync_cfd=False):
+        self.num_envs = num_envs
+
+        shapes = [(num_envs, *observation_shape), (num_envs, *(action_shape or (1,))), (num_envs,), (num_envs,)]
+        self.shared = [multiprocessing.RawArray('d', int(np.prod(shape))) for shape in shapes]
+        self.observations, self.actions, self.rewards, self.dones = _as_arrays(self.shared, shapes)
+
+        self.remotes, self.processes = [], []
+        for index in range(num_envs):
+            remote, worker_remote = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_worker, daemon=True,
+                                              args=(worker_remote, env_fn, index, self.shared, shapes, sync_cfd))
+            process.start()
+            worker_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+
+    def _send(self, command, indices, data=None):
+        for i in indices:
+            self.remotes[i].send((command, data))
+        results = [self.remotes[i].recv() for i in indices]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def reset(self, indices=None):
+        indices = range(self.num_envs) if indices is None else indices
+        self._send('reset', indices)
+        return self.observations[indices].copy()
+
+    def step(self, actions):
+        self.actions[:] = np.asarray(actions).reshape(self.actions.shape)
+        self._send('step', range(self.num_envs))
+        return self.observations.copy(), self.rewards.copy(), self.dones.astype(bool)
+
+    def call(self, name, *args, indices=None):
+        """Calls a method of the environments of indices (all by default) and returns the results."""
+        return self._send('call', range(self.num_envs) if indices is None else indices, (name, args))
+
+    def close(self):
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for remote, process in zip(self.remotes, self.processes):
+            remote.recv()
+            process.join()